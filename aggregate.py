@@ -16,19 +16,31 @@
 # * Sensors requiring battery replacement (~2.2V)
 # * Decimal place formatting (1dp)                  ✅
 #
+import os
 import logging
+import functools
+import jinja2
 import pandas as pd
 import numpy as np
 import datahandling as dh
-from flask_table import NestedTableCol, Table, Col, create_table
 
 # Set up logging
 log = logging.getLogger(__name__)
 
 
-# Default range for data considered to be within "working hours"
+# Default range for data considered to be within "working hours". Whole hours, so that hourly rollups
+# (dh.rollup) can be limited to the same rows as the samples they summarise
 WORK_HOURS = ('09:00', '17:00')
 
+# Windows of time the summary tables can be made for (see window_masks):
+WINDOWS = {
+    # Name: label          |description
+    'work':    ("Working hours", "9am-5pm"),
+    'out':     ("Out of hours",  "before 9am and from 5pm"),
+    'weekend': ("Weekends",      "all of Saturday and Sunday"),
+    'all':     ("All hours",     "all day, every day"),
+}
+
 # Operations to run on the aggregated data to pull out interesting stats:
 DEFAULT_OPERATIONS = {
     # Series : column |operation |label
@@ -51,104 +63,329 @@ DEFAULT_OPERATIONS = {
     # "Battery": [("min", "idxmin", "Lowest battery")]
 }
 
+# Aggregations of each series for every period and sensor (mean, min, max, range, count or std):
+AGGREGATIONS = {
+    'Temp': ['mean', 'min', 'max', 'range', 'count'],
+    'Humidity': ['mean', 'min', 'max', 'range', 'count'],
+    'Light': ['mean', 'min', 'max', 'count'],
+    'Battery': ['min', 'count']
+}
+
+# Array functions for the operations in DEFAULT_OPERATIONS, and the fill value which makes a missing value lose
+WINNERS = {
+    'idxmax': (np.argmax, -np.inf),
+    'idxmin': (np.argmin, np.inf),
+}
+
 
 #
 # Extract statistics from aggregated table
+# Each operation picks the winning sensor for every period at once: the column of aggregates is unstacked to a
+# (period x sensor) array and reduced with argmax/argmin. Sensors without data in a period can't win, and a
+# period with no data at all for a series shows '-'
 #
 def extract_stats(agg, operations=DEFAULT_OPERATIONS):
 
     results = {}
-    for time_period in agg.index.levels[0]:
-        log.debug("{0:%B %Y}".format(time_period))  # TODO: Cope with weeks being passed
-        sub_frame = agg.loc[time_period]
+    for series in operations:
+        for agg_val, operation, label in operations[series]:
+            if operation not in WINNERS:
+                raise ValueError("Unknown operation '{0}': use one of {1}".format(operation, ", ".join(WINNERS)))
 
-        stats = {}
-        for series in operations:
-            if series not in stats:
-                stats[series] = []
+            table = agg[(series, agg_val)].unstack()
+            values = table.values.astype(np.float64)
+            missing = np.isnan(values)
 
-            for agg_val, operation, label in operations[series]:
+            func, fill = WINNERS[operation]
+            winners = func(np.where(missing, fill, values), axis=1)
+            has_data = ~missing.all(axis=1)
 
-                name = getattr(sub_frame[(series, agg_val)], operation)()
-                value = sub_frame.loc[name][(series, agg_val)]
+            for i, time_period in enumerate(table.index):
+                stats = results.setdefault(time_period, {}).setdefault(series, [])
 
-                log.debug("{0}: ({1}) - {2} @ {3:.1f}".format(series, label, name, value))
+                if not has_data[i]:
+                    stats.append((label, '-', '-'))
+                    continue
 
-                stats[series].append((label, name, '{0:.1f}'.format(value)))
+                name, value = table.columns[winners[i]], values[i, winners[i]]
+                log.debug("{0:%d %B %Y} {1}: ({2}) - {3} @ {4:.1f}".format(time_period, series, label, name, value))
 
-        log.debug("\n")
-        results[time_period] = stats
+                stats.append((label, name, '{0:.1f}'.format(value)))
 
     return results
 
 
 #
-# Perform multi-column aggregation
+# Return the partial aggregates of a series for each row of df: (valid rows or None for all, counts or None for
+# one each, sums, mins, maxes). Rows are either samples, or the hours/days of a rollup (see dh.rollup), whose
+# counts, sums (mean x count), mins and maxes merge into the same aggregates as the samples they summarise
+#
+def partials(df, series):
+    if series + '_count' in df:
+        counts = df[series + '_count'].values
+        return counts > 0, counts, df[series + '_mean'].values * counts, df[series + '_min'].values, \
+            df[series + '_max'].values
+
+    values = df[series].values
+    return ~np.isnan(values) if values.dtype.kind == 'f' else None, None, values, values, values
+
+
+#
+# Perform multi-column aggregation: a table of the AGGREGATIONS (columns) for each period and sensor with data
+# (rows). freq is 'W' (weeks, Monday to Sunday) or 'M' (months), and periods are labelled by their last day,
+# as with pd.Grouper. df is either the cleaned data or a rollup of it (e.g. pd.concat of dh.rollup's hours)
 #
-def aggregate(df: pd.DataFrame, freq='M'):
-    return df.groupby([pd.Grouper(freq=freq), 'Name']).agg({
-        'Temp': ['mean', 'min', 'max', find_range],
-        'Humidity': ['mean', 'min', 'max', find_range],
-        'Light': ['mean', 'min', 'max'],
-        'Battery': ['min']
-    }).rename(columns={'find_range': 'range'})
+def aggregate(df: pd.DataFrame, freq='M', aggregations=AGGREGATIONS):
+    return aggregate_windows(df, {None: None}, freq, aggregations)[None]
 
 
 #
-# Construct and return a table using Flask-Table
+# Perform multi-column aggregation (as aggregate) for several windows of time at once: masks maps each window
+# to a boolean array selecting its rows of df (see window_masks), or None for all rows. Returns a dict of tables
 #
-def get_table(headers, items, name):
+def aggregate_windows(df: pd.DataFrame, masks, freq='M', aggregations=AGGREGATIONS):
+    parts = partial_aggregates(df, masks, freq, aggregations)
+    return {w: finish_aggregates(parts[w], aggregations) for w in masks}
 
-    table = create_table(name+'Table', base=Table)
-    for h in headers:
-        table.add_column(h, Col(h))
 
-    # Populate, construct & return the table
-    return table(items)
+#
+# Perform multi-column aggregation (as aggregate_windows) out of core: frames is an iterable of partitions of the
+# data (e.g. the months of a store, from store.iter_months), each of which is aggregated in turn to statistics
+# which merge across partitions (see partial_aggregates), so only one partition need be in memory at a time.
+# The tables are the same as those of aggregating all of the data at once. Returns a dict of tables (empty
+# if there's no data)
+#
+def aggregate_partitions(frames, windows, freq='M', aggregations=AGGREGATIONS):
+    parts = {w: [] for w in windows}
+    for df in frames:
+        for w, part in partial_aggregates(df, window_masks(df, windows), freq, aggregations).items():
+            parts[w].append(part)
+
+    return {w: finish_aggregates(merge_partials(parts[w]), aggregations) for w in windows if parts[w]}
 
 
 #
-# Transpose a list of lists
+# Aggregate df to the statistics of each series which merge across partitions of the data: 'count', 'sum', 'min',
+# 'max' and, for series with a 'std' aggregation, 'm2' (the sum of squared deviations from the mean, as kept by
+# Welford's algorithm). Returns a dict (one per mask, as aggregate_windows) of tables of the statistics (columns)
+# for each (period, sensor) group with rows in the window (rows)
 #
-def transpose(l: list):
-    return list(map(list, zip(*l)))
+# Rows are numbered by (cell, period, sensor) group, where a row's cell is the set of windows it's in (one bit
+# each), and each statistic is a single pass of a numpy reduction (bincount, minimum.at, maximum.at) over the
+# rows, rather than groupby calling back into Python per group. The statistics of each window then merge those
+# of the cells in it, so overlapping windows don't need the data to be filtered for each
+#
+def partial_aggregates(df: pd.DataFrame, masks, freq='M', aggregations=AGGREGATIONS):
+    # Period of each row, numbered from the first
+    groups = dh.floor_periods(df.index.values, freq).view(np.int64)
+    first = groups.min() if len(groups) else 0
+    groups -= first
+    if freq == 'W':
+        groups //= 7
+    n_periods = groups.max() + 1 if len(groups) else 0
+
+    # Sensor of each row, numbered in (category) order, as groupby sorts them
+    if isinstance(df['Name'].dtype, pd.CategoricalDtype):
+        sensors, names = df['Name'].cat.codes.values, df['Name'].cat.categories
+    else:
+        sensors, names = pd.factorize(df['Name'], sort=True)
+
+    # Cells of each window (those with its bit set), and the cell of each row
+    bits = [w for w in masks if masks[w] is not None]
+    n_cells = 1 << len(bits)
+    cells = {w: (np.arange(n_cells) >> bits.index(w)) & 1 == 1 if w in bits else np.ones(n_cells, dtype=bool)
+             for w in masks}
+
+    # Group of each row: (cell, period, sensor)
+    n_groups = n_periods * len(names)
+    groups *= len(names)
+    groups += sensors
+    for bit, w in enumerate(bits):
+        groups += (masks[w].astype(np.int64) << bit) * n_groups
+    rows = np.bincount(groups, minlength=n_cells * n_groups).reshape(n_cells, n_groups)
+
+    columns = {w: {} for w in masks}
+    for series, funcs in aggregations.items():
+        valid, counts, sums, row_mins, row_maxs = partials(df, series)
+        group = groups
+
+        # Skip missing values, as pandas' reductions do
+        if valid is not None and not valid.all():
+            group, sums, row_mins, row_maxs = groups[valid], sums[valid], row_mins[valid], row_maxs[valid]
+            counts = counts[valid] if counts is not None else None
+
+        count = np.bincount(group, weights=counts, minlength=n_cells * n_groups).astype(np.int64)
+        dtype = row_mins.dtype
+        limits = np.finfo(dtype) if dtype.kind == 'f' else np.iinfo(dtype)
+
+        mins = np.full(n_cells * n_groups, limits.max, dtype=dtype)
+        maxs = np.full(n_cells * n_groups, limits.min, dtype=dtype)
+        np.minimum.at(mins, group, row_mins)
+        np.maximum.at(maxs, group, row_maxs)
+        totals = np.bincount(group, weights=sums, minlength=n_cells * n_groups)
+
+        # Squared deviations of the samples from the mean of their group
+        if 'std' in funcs:
+            if counts is not None:
+                raise ValueError("The standard deviation of {0} needs the samples: rollups don't keep it"
+                                 .format(series))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                deviations = sums - (totals / count)[group]
+            m2 = np.bincount(group, weights=deviations * deviations, minlength=n_cells * n_groups)
+            m2 = m2.reshape(n_cells, n_groups)
+
+        count, totals = count.reshape(n_cells, n_groups), totals.reshape(n_cells, n_groups)
+        mins, maxs = mins.reshape(n_cells, n_groups), maxs.reshape(n_cells, n_groups)
+
+        for w in masks:
+            stats = {'count': count[cells[w]].sum(axis=0), 'sum': totals[cells[w]].sum(axis=0),
+                     'min': mins[cells[w]].min(axis=0), 'max': maxs[cells[w]].max(axis=0)}
+            if 'std' in funcs:
+                stats['m2'] = merge_m2(count[cells[w]], totals[cells[w]], m2[cells[w]])
+
+            # Sensors with rows in a period but only missing values have no min or max
+            if dtype.kind == 'f':
+                stats['min'][stats['count'] == 0], stats['max'][stats['count'] == 0] = np.nan, np.nan
+
+            for stat, values in stats.items():
+                columns[w][(series, stat)] = values
+
+    tables = {}
+    for w in masks:
+        # Keep the (period, sensor) groups with rows in the window
+        keep = np.flatnonzero(rows[cells[w]].sum(axis=0))
+        starts = np.datetime64(int(first), 'D' if freq == 'W' else 'M') + \
+            (keep // len(names)) * (7 if freq == 'W' else 1)
+        ends = starts + 6 if freq == 'W' else (starts + 1).astype('datetime64[D]') - 1
+
+        index = pd.MultiIndex.from_arrays([pd.DatetimeIndex(ends.astype('datetime64[ns]'), name=df.index.name),
+                                           pd.CategoricalIndex(names[keep % len(names)], categories=names,
+                                                               name='Name')])
+
+        tables[w] = pd.DataFrame({column: values[keep] for column, values in columns[w].items()}, index=index,
+                                 columns=pd.MultiIndex.from_tuples(columns[w].keys()))
+
+    return tables
 
 
 #
-# Function to calculate range (where x is a series)
+# Merge the m2 of parts (rows) of each group (columns) from their counts, sums and m2s,
+# with the pairwise update of Welford's algorithm (Chan et al.)
 #
-def find_range(x):
-    return np.ptp(x)
+def merge_m2(counts, sums, m2s):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        deviations = np.where(counts > 0, counts * (means - sums.sum(axis=0) / counts.sum(axis=0)) ** 2, 0)
+    return m2s.sum(axis=0) + deviations.sum(axis=0)
+
+
+#
+# Merge tables of partial_aggregates (e.g. of consecutive months, whose weeks may span two) into one
+#
+def merge_partials(parts):
+    both = pd.concat(parts)
+    if not both.index.has_duplicates:
+        return both.sort_index()
+
+    group = lambda values: values.groupby(level=[0, 1], sort=True, observed=True)
+    merged = group(both).agg({column: 'sum' if column[1] in ('count', 'sum', 'm2') else column[1]
+                              for column in both.columns})
+
+    # Add the deviations of each part's mean from the merged mean to the m2 of the parts (see merge_m2)
+    for series in [column[0] for column in both.columns if column[1] == 'm2']:
+        counts, sums = both[(series, 'count')], both[(series, 'sum')]
+        means = group(sums).transform('sum') / group(counts).transform('sum')
+        deviations = (counts * (sums / counts - means) ** 2).where(counts > 0, 0)
+        merged[(series, 'm2')] += group(deviations).sum()
+
+    return merged
+
+
+#
+# Finish tables of partial_aggregates to the AGGREGATIONS of each series, as aggregate returns
+#
+def finish_aggregates(part, aggregations=AGGREGATIONS):
+    columns = {}
+    for series, funcs in aggregations.items():
+        count = part[(series, 'count')].values
+        mins, maxs = part[(series, 'min')].values, part[(series, 'max')].values
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = part[(series, 'sum')].values / count
+            std = np.sqrt(np.where(count > 1, part[(series, 'm2')].values / (count - 1), np.nan)) \
+                if 'std' in funcs else None
+
+        # Means (and standard deviations) of float series keep their precision, as pandas' do
+        if mins.dtype.kind == 'f':
+            means = means.astype(mins.dtype)
+            std = std.astype(mins.dtype) if std is not None else None
+
+        results = {'mean': means, 'min': mins, 'max': maxs, 'range': maxs - mins, 'count': count, 'std': std}
+        for func in funcs:
+            columns[(series, func)] = results[func]
+
+    return pd.DataFrame(columns, index=part.index, columns=pd.MultiIndex.from_tuples(columns.keys()))
 
 
 #
 # Limit dataframe to values within the passed hours only
+# (hourly rollups too, which are indexed by the start of the hour, for whole hours t_start to t_end)
 #
 def limit_by_hours(df: pd.DataFrame, t_start=WORK_HOURS[0], t_end=WORK_HOURS[1]):
-    return df.iloc[df.index.indexer_between_time(t_start, t_end, include_start=True, include_end=False)]
+    seconds, _ = dh.time_of_day(df.index.values)
+    return df[hours_mask(seconds, t_start, t_end)]
 
 
 #
-# Perform tabulation of data to html <table>
+# Boolean mask of the times of day (seconds since midnight, from dh.time_of_day) from t_start up to t_end,
+# which may wrap past midnight (e.g. '22:00' to '06:00'), as with DatetimeIndex.indexer_between_time
 #
-def tabulate(stats):
+def hours_mask(seconds, t_start=WORK_HOURS[0], t_end=WORK_HOURS[1]):
+    start, end = [(pd.Timestamp(t) - pd.Timestamp(t).normalize()) // pd.Timedelta('1s') for t in (t_start, t_end)]
+    if start <= end:
+        return (seconds >= start) & (seconds < end)
+    return (seconds >= start) | (seconds < end)
 
-    # create a nested table using NestedTableCol
-    TopTable = create_table('TopTable', base=Table)
 
-    # Mung data until it looks good for tabulation:
-    items = {}
-    for series in stats:
-        t_data = transpose(stats[series])                       # Transpose row/col ordering
-        headers = t_data[0]                                     # Separate out headers
-        t_data = [dict(zip(headers, v)) for v in t_data[1:]]    # Separate the rest of the rows
-        items[series.lower() + '_table'] = t_data               # Store items for table construction
-        table = get_table(headers, t_data, series)              # Construct sub-table class
+#
+# Return boolean masks of the rows of df in each of the windows of time (names from WINDOWS), for
+# aggregate_windows. The time of day of each row is found once and shared by all of the windows
+#
+def window_masks(df: pd.DataFrame, windows):
+    seconds, weekdays = dh.time_of_day(df.index.values)
 
-        # Tabulate the data: add column to top-level table for this series
-        TopTable.add_column(series.lower() + '_table', NestedTableCol(dh.TYPE_LABELS[series], table.__class__))
+    masks = {}
+    for w in windows:
+        if w not in WINDOWS:
+            raise ValueError("Unknown window '{0}': use one of {1}".format(w, ", ".join(WINDOWS)))
+        if w == 'work':
+            masks[w] = hours_mask(seconds)
+        elif w == 'out':
+            masks[w] = ~hours_mask(seconds)
+        elif w == 'weekend':
+            masks[w] = weekdays >= 5
+        else:
+            masks[w] = None
 
-    return TopTable([items])
+    return masks
+
+
+#
+# Perform tabulation of data to html <table>: a table for each series of stats (as extract_stats returns for one
+# period) nested in a table of the series. Returns Markup, rendered by the macros of templates/tables.htm
+#
+def tabulate(stats):
+    return table_macros().stats_table(stats, dh.TYPE_LABELS)
+
+
+#
+# Macros of templates/tables.htm, compiled once (on first use) and shared by every call to tabulate
+#
+@functools.lru_cache(maxsize=None)
+def table_macros():
+    template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=template_dir), autoescape=True)
+    return environment.get_template('tables.htm').module
 
 
 #
@@ -182,9 +419,6 @@ def test(argv):
 
     # ===============================================
     # Create Jinja2 template and populate with tables
-    import jinja2
-    import os
-
     template_dir = os.path.join(sys.path[0], "templates")
     environment = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=template_dir))
 
@@ -195,7 +429,8 @@ def test(argv):
     environment.filters['datetimeformat'] = datetimeformat
 
     html = environment.get_template('aggregates.htm').render({
-        'table_list': zip(list(stats.keys()), table_list),
+        'table_list': [(month, [(WINDOWS['work'][0], table)]) for month, table in zip(stats.keys(), table_list)],
+        'windows': [WINDOWS['work']],
     })
 
     show(html)
@@ -0,0 +1,855 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Benchmarks for the report generation pipeline, run on synthetic data:
+#     ./benchmark.py [name ...]
+#
+import io
+import os
+import base64
+import time
+import shutil
+import tempfile
+import tracemalloc
+import logging
+import argparse
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+import datahandling as dh
+import graphing as gr
+import aggregate as ag
+import store as st
+
+log = logging.getLogger(__name__)
+
+
+#
+# Time a function call, returning (result, seconds)
+#
+def timed(func, *args, **kwargs):
+    start_time = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start_time
+
+
+#
+# Generate synthetic binary units as written by BAXTest in raw mode (-Mr):
+# nsensors sensors each reporting every `interval` seconds
+#
+def gen_units(n=200000, nsensors=40, interval=10, seed=123456):
+    rng = np.random.RandomState(seed)
+
+    times = pd.Timestamp('2017-01-02') + pd.to_timedelta(np.arange(n) * interval // nsensors, unit='s')
+
+    units = np.zeros(n, dtype=dh.BAX_UNIT)
+    units['DataNumber'] = np.arange(n)
+    units['DataTime'] = ((times.year.values - 2000) << 26 | times.month.values << 22 | times.day.values << 17 |
+                         times.hour.values << 12 | times.minute.values << 6 | times.second.values)
+    units['Address'] = 0x42000000 + rng.randint(0, 0xffffff, size=nsensors)[np.arange(n) % nsensors]
+    units['RSSI'] = rng.randint(0, 255, size=n)
+    units['Type'] = rng.choice(dh.SENSOR_PACKET_TYPES, size=n)
+    units['SequenceNo'] = np.arange(n) // nsensors % 256
+    units['TransmitPower'] = 0
+    units['Battery'] = rng.randint(2200, 3300, size=n)
+    units['HumiditySat'] = rng.randint(20 << 8, 90 << 8, size=n)
+    units['Temp'] = rng.randint(150, 300, size=n)
+    units['Light'] = rng.randint(0, 1500, size=n)
+    units['PIRCount'] = rng.randint(0, 100, size=n)
+    units['PIREnergy'] = np.cumsum(rng.randint(0, 500, size=n)) % 65536
+    units['Switch'] = 0
+
+    return units
+
+
+#
+# Format binary units as CSV text, as written by BAXTest in CSV mode (-Mc)
+#
+def units_to_csv(units):
+    df = dh.units_to_df(units)
+    humidity = units['HumiditySat']
+    lines = [
+        "{0:%Y/%m/%d,%H:%M:%S},{1},{2},{3},{4},{5},{6},{7}.{8:02d},{9},{10},{11},{12},{13}\r\n".format(
+            t, r.Name.decode('utf-8'), r.RSSI, r.Type, r.SequenceNo, r.TransmitPower, r.Battery,
+            h >> 8, (h & 0xff) * 39 // 100, r.Temp, r.Light, r.PIRCount, r.PIREnergy, r.Switch)
+        for t, r, h in zip(df.index, df.itertuples(), humidity)
+    ]
+    return ''.join(lines)
+
+
+#
+# Binary decode (np.frombuffer) vs. CSV round-trip for BAXTest output
+#
+def bench_binary(n=200000):
+    units = gen_units(n)
+    raw = units.tobytes()
+    text = units_to_csv(units)
+
+    log.info("Synthetic data: {0} units ({1:.1f} MB binary, {2:.1f} MB CSV)"
+             .format(n, len(raw) / 1e6, len(text) / 1e6))
+
+    df_csv, t_csv = timed(dh.df_from_csv, io.StringIO(text))
+    df_bin, t_bin = timed(dh.df_from_units, io.BytesIO(raw))
+
+    log.info("CSV path:    {0:.2f}s".format(t_csv))
+    log.info("Binary path: {0:.2f}s ({1:.1f}x)".format(t_bin, t_csv / t_bin))
+
+    # Both paths must decode the same values, whether or not the CSV is parsed in chunks
+    pd.testing.assert_frame_equal(df_csv, df_bin, check_dtype=False)
+    pd.testing.assert_frame_equal(dh.df_from_csv(io.StringIO(text), chunksize=n // 7), df_csv)
+
+
+#
+# Generate synthetic sensor frames (as split by dh.split_by_id, before cleaning) in which the
+# humidity repeatedly climbs past 80% and overflows to low values for a while
+#
+def gen_sensor_frames(n=100000, nsensors=10, interval=10, seed=123456):
+    rng = np.random.RandomState(seed)
+    index = pd.date_range('2017-01-02', periods=n, freq='{0}s'.format(interval), name='DateTime')
+
+    dfs = {}
+    for s in range(nsensors):
+        humidity = 60 + 30 * np.sin(np.arange(n) / rng.randint(50, 500)) + rng.normal(0, 2, size=n)
+        humidity = np.where(humidity > 85, humidity - 60, humidity)     # overflow
+        humidity[rng.randint(0, n, size=n // 1000)] = np.nan             # scrubbed by limit_range
+        temp = rng.randint(-50, 400, size=n).astype(float)              # x10, as at fix_humidity
+
+        dfs["42{0:06X}".format(s)] = pd.DataFrame({'Humidity': humidity, 'Temp': temp}, index=index)
+
+    return dfs
+
+
+#
+# Generate cleaned synthetic data (from gen_units) for weekly figures: `weeks` weeks of readings from nsensors
+# sensors each reporting every `interval` seconds, starting on a Monday.
+# Returns (df, dfs, periods), with the data's weeks as (t_start, t_end) periods (as report.get_week_range)
+#
+def synthetic_weeks(nsensors=10, interval=600, weeks=12):
+    n = weeks * 7 * 24 * 60 * 60 // interval * nsensors
+    df = dh.units_to_df(gen_units(n, nsensors=nsensors, interval=interval))
+    dh.fix_names(df)
+    dfs = dh.clean_data(dh.split_by_id(df))
+
+    return df, dfs, dh.get_periods(df.index, 'W')
+
+
+#
+# Original (stateful rolling apply) implementation of dh.fix_humidity, kept verbatim as a reference apart from
+# the two lines marked 'ported', which don't run on current pandas and numpy as they were.
+# It carries the overflow state over from one sensor to the next
+#
+def fix_humidity_reference(dfs):
+    # Constants from Analog.c
+    lookup = np.array([
+        [0,  18168,  2560],  # 05˚C
+        [8,  19092,  2560],  # 10˚C
+        [10, 19761,  2619],  # 15˚C
+        [14, 20480,  2681],  # 20˚C
+        [18, 21662,  2681],  # 25˚C
+        [23, 22086,  2747],  # 30˚C
+        [28, 22528,  2816],  # 35˚C
+        [34, 23467,  2816],  # 40˚C
+        [40, 23966,  2888],  # 45˚C
+        [45, 24487,  2888],  # 50˚C
+        [51, 24487,  2888],  # 55˚C
+        [54, 25031,  2964]])
+
+    # Pre-compute interpolation skew
+    # temp2index = np.array([5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60])
+    temp_humid_skews = [(t[-1] - t[0]) / (t[-1] - t[-2]) for t in lookup]
+
+    # Stateful function to determine overflowed values
+    def humidity_needsfix(x):
+        if x[2] < 55 and (humidity_needsfix.broken or np.mean(x[:2]) > 80):
+            humidity_needsfix.broken = True
+            return True
+        humidity_needsfix.broken = False
+        return False
+
+    # static var used for state on humidity_needsfix closure
+    humidity_needsfix.broken = False
+
+    # Conditionally 'fix' incorrect values
+    def fix_humidity_values(d):
+        temp_index = min(max(0, np.floor(d.Temp/5)-1), 11)
+        return min(90 + ((55 - d.Humidity) / temp_humid_skews[int(temp_index)]), 100)  # ported: numpy float index
+
+    for i in dfs:
+        df = dfs[i]
+
+        # Determine if overflowing with window (this value low, previous values high)
+        needs_fix = df[['Humidity']].rolling(
+            window=5,
+            center=True
+        ).apply(
+            func=humidity_needsfix,
+            raw=True    # ported: x[2] indexes by label, not position, in the Series passed without raw
+        ).loc[:, 'Humidity']
+
+        # Apply fix to affected rows using temperature adjustment
+        df.loc[needs_fix > 0, 'Humidity'] = df.loc[needs_fix > 0][['Temp', 'Humidity']] \
+            .apply(fix_humidity_values, axis=1)
+
+    return dfs
+
+
+#
+# Vectorized dh.fix_humidity vs. the original rolling apply (outputs must be identical).
+# dh.fix_humidity starts each sensor clear, so the original is run on one sensor at a time
+#
+def bench_humidity(n=100000):
+    dfs = gen_sensor_frames(n)
+
+    reference, t_ref = timed(lambda: {k: fix_humidity_reference({k: v.copy()})[k] for k, v in dfs.items()})
+    fixed, t_new = timed(dh.fix_humidity, {k: v.copy() for k, v in dfs.items()})
+
+    log.info("Rolling apply: {0:.2f}s".format(t_ref))
+    log.info("Vectorized:    {0:.2f}s ({1:.1f}x)".format(t_new, t_ref / t_new))
+
+    for k in dfs:
+        pd.testing.assert_frame_equal(reference[k], fixed[k])
+    log.info("Fixed {0} of {1} values identically".format(
+        sum((reference[k].Humidity.fillna(0) != dfs[k].Humidity.fillna(0)).sum() for k in dfs), n * len(dfs)))
+
+    # A sensor whose humidity starts low isn't fixed because the sensor before it ended overflowed
+    # (the original carried the state over, and fixed it)
+    overflowed = pd.DataFrame({'Humidity': [60.0, 60, 85, 85, 30, 30, 30, 30, 30], 'Temp': 200.0})
+    low = pd.DataFrame({'Humidity': [30.0] * 8, 'Temp': 200.0})
+
+    fixed = dh.fix_humidity({'A': overflowed.copy(), 'B': low.copy()})
+    assert not fixed['A'].equals(overflowed) and fixed['B'].equals(low)
+    assert not fix_humidity_reference({'A': overflowed.copy(), 'B': low.copy()})['B'].equals(low)
+
+
+#
+# Time each stage of the cleaning pipeline (as run by dh.read_data)
+#
+def bench_clean(n=1000000):
+    df = dh.units_to_df(gen_units(n))
+    log.info("Synthetic data: {0} rows, {1} sensors".format(len(df), df.Name.nunique()))
+
+    stages = [
+        ('fix_names',    lambda d: (dh.fix_names(d), d)[1]),
+        ('split_by_id',  dh.split_by_id),
+        ('limit_range',  dh.limit_range),
+        ('fix_light',    dh.fix_light),
+        ('fix_humidity', dh.fix_humidity),
+        ('fix_temp',     dh.fix_temp),
+        ('diff_pir',     dh.diff_pir),
+    ]
+
+    total = 0
+    for name, stage in stages:
+        df, t = timed(stage, df)
+        total += t
+        log.info("{0: <12} {1:.2f}s".format(name, t))
+
+    log.info("{0: <12} {1:.2f}s".format('total', total))
+
+
+#
+# Memory footprint of cleaned data (as returned by dh.read_data) with the compact schema,
+# vs. the previous layout (object names, 64-bit columns)
+#
+def bench_memory(n=1000000):
+    df = dh.units_to_df(gen_units(n))
+    dh.fix_names(df)
+    compact = pd.concat(dh.clean_data(dh.split_by_id(df)).values())
+
+    legacy = compact.astype({c: 'float64' if t.startswith('float') else 'int64' for c, t in dh.BAX_SCHEMA.items()})
+    legacy['Name'] = legacy['Name'].astype(object)
+
+    old_usage = legacy.memory_usage(deep=True)
+    new_usage = compact.memory_usage(deep=True)
+
+    log.info("{0: <14} {1: >10} {2: >10}".format('Column', 'Old (MB)', 'New (MB)'))
+    for column in old_usage.index:
+        log.info("{0: <14} {1: >10.1f} {2: >10.1f}".format(column, old_usage[column] / 1e6, new_usage[column] / 1e6))
+
+    log.info("{0: <14} {1: >10.1f} {2: >10.1f} ({3:.0f}%)".format(
+        'Total', old_usage.sum() / 1e6, new_usage.sum() / 1e6, 100 * new_usage.sum() / old_usage.sum()))
+
+
+#
+# Weekly figures rendered in parallel from shared memory vs. in a single process
+#
+def bench_figures(nsensors=20, interval=60, weeks=14):
+    df, dfs, periods = synthetic_weeks(nsensors, interval, weeks)
+    types = [(t, dh.TYPE_LABELS[t]) for t in ['Temp', 'Humidity', 'Light']]
+    log.info("Synthetic data: {0} rows, {1} sensors, {2} figures".format(len(df), len(dfs), len(periods) * len(types)))
+
+    # As report.plot_figures_single_threaded. PNG output has no timestamp, so identical figures give identical output
+    single, t_single = timed(lambda: [[gr.weekly_graph(dfs, *t, *p, figure_format='png') for p in periods]
+                                      for t in types])
+    shared, t_shared = timed(gr.plot_figures_shared, dfs, periods, types, figure_format='png')
+
+    log.info("Single process: {0:.2f}s".format(t_single))
+    log.info("Shared memory:  {0:.2f}s ({1:.1f}x, {2} workers)".format(
+        t_shared, t_single / t_shared, min(gr.workers.MAX_WORKERS, len(periods) * len(types))))
+
+    assert shared == single, "Figures rendered in parallel differ from those rendered in a single process"
+
+
+#
+# Per-subplot data slicing for a year-long weekly report: .loc per sensor and cell vs. gr.SliceIndex
+#
+def bench_slices(nsensors=50, days=365, interval=300):
+    n = days * 24 * 60 * 60 // interval * nsensors
+    df = dh.units_to_df(gen_units(n, nsensors=nsensors, interval=interval))
+    dh.fix_names(df)
+    dfs = dh.split_by_id(df)
+
+    series = ['Temp', 'Humidity', 'Light']
+    t_start = df.index.min().normalize() - pd.Timedelta(days=df.index.min().weekday())
+    cells = [(day, day + pd.Timedelta('1 day')) for day in pd.date_range(t_start, df.index.max(), freq='D')]
+    log.info("Synthetic data: {0} rows, {1} sensors, {2} weeks".format(len(df), len(dfs), len(cells) // 7))
+
+    # As weekly_graph did: two .loc lookups per sensor per cell
+    def loc_slices():
+        for s in series:
+            for start, end in cells:
+                x_data = [dfs[i].loc[start:end, ].index for i in dfs]
+                y_data = [dfs[i].loc[start:end, s].values for i in dfs]
+
+    def index_slices():
+        slices = gr.SliceIndex(dfs)
+        for s in series:
+            for start, end in cells:
+                x_data, y_data = slices.get(s, start, end)
+
+    _, t_loc = timed(loc_slices)
+    _, t_index = timed(index_slices)
+
+    log.info(".loc:       {0:.2f}s".format(t_loc))
+    log.info("SliceIndex: {0:.2f}s ({1:.1f}x)".format(t_index, t_loc / t_index))
+
+
+#
+# Size and render time of a dense weekly figure, with and without downsampling (--max_points)
+#
+def bench_downsample(nsensors=20, interval=10, max_points=2000):
+    df, dfs, [(t_start, t_end)] = synthetic_weeks(nsensors, interval, weeks=1)
+    log.info("Synthetic data: {0} rows, {1} sensors, one week".format(len(df), len(dfs)))
+
+    for method in [None] + list(gr.DOWNSAMPLE_METHODS):
+        svg, t = timed(gr.weekly_graph, dfs, 'Temp', 'Temperature', t_start, t_end,
+                       max_points=max_points if method else None, downsample=method)
+        log.info("{0: <8} {1:6.2f}s {2:8.1f} kB".format(method or 'none', t, len(svg) / 1e3))
+
+
+#
+# Figure formats (gr.FIGURE_FORMATS): render time and size of weekly figures, and the time WeasyPrint
+# takes to lay them out in a PDF (if WeasyPrint is installed)
+#
+def bench_formats(nsensors=20, interval=60, weeks=4):
+    df, dfs, periods = synthetic_weeks(nsensors, interval, weeks)
+    log.info("Synthetic data: {0} rows, {1} sensors, {2} figures".format(len(df), len(dfs), len(periods)))
+
+    try:
+        import weasyprint
+    except (ImportError, OSError):  # OSError: missing native libraries (Pango)
+        weasyprint = None
+        log.warning("WeasyPrint isn't available: skipping PDF timings")
+
+    for fmt, mime in gr.FIGURE_FORMATS.items():
+        slices = gr.SliceIndex(dfs)
+        figs, t_render = timed(lambda: [gr.weekly_graph(dfs, 'Temp', 'Temperature', *p, slices=slices,
+                                                        figure_format=fmt) for p in periods])
+        size = sum(len(f) for f in figs)
+
+        if weasyprint is None:
+            log.info("{0: <10} render {1:6.2f}s {2:8.1f} kB".format(fmt, t_render, size / 1e3))
+            continue
+
+        html = ''.join('<img src="data:{0};charset=utf-8;base64,{1}" />'.format(mime, f) for f in figs)
+        pdf, t_pdf = timed(weasyprint.HTML(string=html).write_pdf)
+        log.info("{0: <10} render {1:6.2f}s {2:8.1f} kB, PDF {3:6.2f}s {4:8.1f} kB".format(
+            fmt, t_render, size / 1e3, t_pdf, len(pdf) / 1e3))
+
+
+#
+# Weekly figures for a report, each built from scratch vs. reusing a styled figure template.
+# Also checks that figures drawn on a template are the same as those built from scratch
+#
+def bench_templates(nsensors=10, interval=600, weeks=12):
+    df, dfs, periods = synthetic_weeks(nsensors, interval, weeks)
+    types = [(t, dh.TYPE_LABELS[t]) for t in ['Temp', 'Humidity', 'Light']]
+    log.info("Synthetic data: {0} rows, {1} sensors, {2} figures".format(len(df), len(dfs), len(periods) * len(types)))
+
+    # PNG output has no timestamp, so identical figures give identical output
+    slices = gr.SliceIndex(dfs)
+    templates = {}
+
+    fresh, t_fresh = timed(lambda: [[gr.weekly_graph(dfs, *t, *p, slices=slices, figure_format='png')
+                                     for p in periods] for t in types])
+    reused, t_reused = timed(lambda: [[gr.weekly_graph(dfs, *t, *p, slices=slices, templates=templates,
+                                                       figure_format='png')
+                                       for p in periods] for t in types])
+    gr.close_templates(templates)
+
+    assert reused == fresh, "Figures drawn on templates differ from those built from scratch"
+
+    # A template's lines are rasterized for svg-raster only: not for a later svg figure on the same template
+    for fmt in ('svg-raster', 'svg'):
+        svg = base64.b64decode(gr.weekly_graph(dfs, *types[0], *periods[0], slices=slices, templates=templates,
+                                               figure_format=fmt)).decode()
+    gr.close_templates(templates)
+
+    assert '<image' not in svg, "An svg figure on a template used for svg-raster has rasterized lines"
+
+    log.info("New figures: {0:.2f}s ({1:.3f}s per figure)".format(t_fresh, t_fresh / len(periods) / len(types)))
+    log.info("Templates:   {0:.2f}s ({1:.3f}s per figure, {2:.1f}x)".format(
+        t_reused, t_reused / len(periods) / len(types), t_fresh / t_reused))
+
+
+#
+# Weekly figures rendered concurrently from a pool of threads, sharing one SliceIndex (filled as they go), must
+# be the same as those rendered one at a time. This is a check of thread safety (as for concurrent server
+# requests), not speed: rendering holds the GIL most of the time, so threads aren't expected to be faster
+#
+def bench_threads(nsensors=10, interval=600, weeks=12, threads=4):
+    df, dfs, periods = synthetic_weeks(nsensors, interval, weeks)
+    jobs = [(t, dh.TYPE_LABELS[t], *p) for t in ['Temp', 'Humidity', 'Light'] for p in periods]
+    log.info("Synthetic data: {0} rows, {1} sensors, {2} figures".format(len(df), len(dfs), len(jobs)))
+
+    # PNG output has no timestamp, so identical figures give identical output
+    def render(jobs, slices):
+        return [gr.weekly_graph(dfs, *job, slices=slices, figure_format='png') for job in jobs]
+
+    serial, t_serial = timed(render, jobs, gr.SliceIndex(dfs))
+    slices = gr.SliceIndex(dfs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        threaded, t_threaded = timed(lambda: list(pool.map(lambda job: render([job], slices)[0], jobs)))
+
+    assert threaded == serial, "Figures rendered from threads differ from those rendered serially"
+
+    log.info("Serial:     {0:.2f}s".format(t_serial))
+    log.info("{0} threads: {1:.2f}s (for reference only)".format(threads, t_threaded))
+
+
+#
+# A monthly report (--months) rendered end to end, as html, from a CSV data file
+#
+def bench_monthly(nsensors=10, interval=600, months=2):
+    import report   # (imports weasyprint)
+
+    n = months * 30 * 24 * 60 * 60 // interval * nsensors
+    units = gen_units(n, nsensors=nsensors, interval=interval)
+    periods = dh.get_periods(dh.units_to_df(units).index, 'M')
+    types = ['temp', 'humidity', 'light']
+    work_dir = tempfile.mkdtemp(prefix='reportgen-')
+
+    try:
+        data_file = os.path.join(work_dir, 'data.csv')
+        with open(data_file, 'w') as f:
+            f.write(units_to_csv(units))
+
+        output_file = os.path.join(work_dir, 'report.htm')
+        _, t_report = timed(report.report, [data_file], output_file=output_file, htm=True, months=True, threshold=1,
+                            series=types, executor='serial')
+
+        with open(output_file, encoding='utf-8') as f:
+            html = f.read()
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    figures = html.count('<img src="data:{0};charset=utf-8;base64,'.format(gr.FIGURE_FORMATS['svg']))
+    log.info("Report of {0} months: {1:.2f}s ({2} figures)".format(len(periods), t_report, figures))
+
+    assert figures == len(periods) * len(types), "Expected a figure per month and series"
+
+
+#
+# Peak memory rendering weekly figures for reports of increasing length: every figure kept in memory
+# (base64 encoded) vs. each written to a file as it's rendered (as report does)
+#
+def bench_stream(nsensors=10, interval=600, weeks=(4, 16)):
+    types = [(t, dh.TYPE_LABELS[t]) for t in ['Temp', 'Humidity', 'Light']]
+
+    log.info("{0: >6} {1: >16} {2: >16}".format('Weeks', 'In memory (MB)', 'To files (MB)'))
+    for w in weeks:
+        df, dfs, periods = synthetic_weeks(nsensors, interval, w)
+        slices = gr.SliceIndex(dfs)
+        figure_dir = tempfile.mkdtemp(prefix='reportgen-')
+
+        peaks = []
+        try:
+            for figure_file in (lambda t, i: None, lambda t, i: gr.figure_path(figure_dir, t, i)):
+                templates = {}
+                tracemalloc.start()
+                figs = [[gr.weekly_graph(dfs, *t, *p, slices=slices, templates=templates,
+                                         figure_file=figure_file(t[0], i)) for i, p in enumerate(periods)]
+                        for t in types]
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+                gr.close_templates(templates)
+                del figs
+        finally:
+            shutil.rmtree(figure_dir, ignore_errors=True)
+
+        log.info("{0: >6} {1: >16.1f} {2: >16.1f}".format(len(periods), peaks[0] / 1e6, peaks[1] / 1e6))
+
+
+#
+# Weekly figures rendered into an empty figure cache, then again with every figure in the cache
+# (as when a report is regenerated with only its description or location changed)
+#
+def bench_figure_cache(nsensors=10, interval=600, weeks=12):
+    df, dfs, periods = synthetic_weeks(nsensors, interval, weeks)
+    types = [(t, dh.TYPE_LABELS[t]) for t in ['Temp', 'Humidity', 'Light']]
+    log.info("Synthetic data: {0} rows, {1} sensors, {2} figures".format(len(df), len(dfs), len(periods) * len(types)))
+
+    figure_cache = tempfile.mkdtemp(prefix='reportgen-')
+    try:
+        render = lambda slices: [[gr.weekly_graph(dfs, *t, *p, slices=slices, figure_cache=figure_cache)
+                                  for p in periods] for t in types]
+        cold, t_cold = timed(render, gr.SliceIndex(dfs))
+        warm, t_warm = timed(render, gr.SliceIndex(dfs))
+    finally:
+        shutil.rmtree(figure_cache, ignore_errors=True)
+
+    assert warm == cold, "Cached figures differ from those rendered"
+
+    log.info("Empty cache: {0:.2f}s".format(t_cold))
+    log.info("Cached:      {0:.2f}s ({1:.0f}x)".format(t_warm, t_cold / t_warm))
+
+
+#
+# Original (groupby with a Python range callback, then per-period lookups) implementation of
+# ag.extract_stats(ag.aggregate(df, freq)), kept as a reference
+#
+def aggregate_reference(df, freq='W', operations=ag.DEFAULT_OPERATIONS):
+    agg = df.groupby([pd.Grouper(freq='ME' if freq == 'M' else freq), 'Name'], observed=True).agg({
+        'Temp': ['mean', 'min', 'max', np.ptp],
+        'Humidity': ['mean', 'min', 'max', np.ptp],
+        'Light': ['mean', 'min', 'max'],
+        'Battery': ['min']
+    }).rename(columns={'ptp': 'range'})
+
+    results = {}
+    for time_period in agg.index.levels[0]:
+        sub_frame = agg.loc[time_period]
+
+        stats = {}
+        for series in operations:
+            stats[series] = []
+            for agg_val, operation, label in operations[series]:
+                name = getattr(sub_frame[(series, agg_val)], operation)()
+                value = sub_frame.loc[name][(series, agg_val)]
+                stats[series].append((label, name, '{0:.1f}'.format(value)))
+
+        results[time_period] = stats
+
+    return results
+
+
+#
+# Generate a synthetic frame of cleaned data (the columns aggregated for the summary tables) for nsensors
+# over a number of days, with a sample from each sensor every interval seconds
+#
+def gen_summary_frame(nsensors=100, days=730, interval=600, seed=123456):
+    rng = np.random.RandomState(seed)
+    n = days * 24 * 60 * 60 // interval * nsensors
+
+    names = pd.CategoricalDtype(['42{0:06X}'.format(i) for i in rng.randint(0, 0xffffff, size=nsensors)])
+    index = pd.DatetimeIndex(pd.Timestamp('2017-01-02') + pd.to_timedelta(np.arange(n) * interval // nsensors,
+                                                                           unit='s'), name='Datetime')
+    df = pd.DataFrame({
+        'Name': pd.Categorical.from_codes(np.arange(n) % nsensors, dtype=names),
+        'Temp': rng.normal(21, 2, size=n).astype('float32'),
+        'Humidity': rng.normal(45, 10, size=n).astype('float32'),
+        'Light': rng.randint(0, 1500, size=n).astype('uint16'),
+        'Battery': rng.randint(2200, 3300, size=n).astype('uint16'),
+    }, index=index)
+    return df
+
+
+#
+# Summary statistics for a report: weekly aggregates of nsensors over two years of working hours.
+# The request was for 1-minute data (105M rows, several GB); pass interval=60 where there's the memory
+#
+def bench_aggregate(nsensors=100, days=730, interval=600, seed=123456):
+    df = ag.limit_by_hours(gen_summary_frame(nsensors, days, interval, seed))
+    log.info("Synthetic data: {0} rows (working hours), {1} sensors".format(len(df), nsensors))
+
+    new, t_new = timed(lambda: ag.extract_stats(ag.aggregate(df, freq='W')))
+    old, t_old = timed(aggregate_reference, df, 'W')
+
+    assert new == old, "Aggregate stats differ from the reference implementation"
+
+    log.info("groupby + lookups: {0:.2f}s".format(t_old))
+    log.info("Single pass:       {0:.2f}s ({1:.1f}x)".format(t_new, t_old / t_new))
+
+
+#
+# Summary statistics for a two-year weekly report read from hourly rollups (dh.rollup), as made once after
+# cleaning (or stored with the data), rather than from the samples
+#
+def bench_rollup(nsensors=100, days=730, interval=600, seed=123456):
+    df = gen_summary_frame(nsensors, days, interval, seed)
+    dfs = dh.split_by_id(df)
+    log.info("Synthetic data: {0} rows, {1} sensors".format(len(df), nsensors))
+
+    hourly, t_rollup = timed(dh.rollup, dfs)
+    rows = pd.concat(hourly.values())
+
+    old, t_old = timed(lambda: ag.extract_stats(ag.aggregate(ag.limit_by_hours(df), freq='W')))
+    new, t_new = timed(lambda: ag.extract_stats(ag.aggregate(ag.limit_by_hours(rows), freq='W')))
+
+    assert new == old, "Aggregate stats from rollups differ from those of the samples"
+
+    log.info("Rollup build:  {0:.2f}s ({1} rows)".format(t_rollup, len(rows)))
+    log.info("From samples:  {0:.2f}s".format(t_old))
+    log.info("From rollups:  {0:.2f}s ({1:.1f}x)".format(t_new, t_old / t_new))
+
+
+#
+# Summary tables for working hours, out of hours and weekends (--hours): filtering the data and aggregating
+# it for each window, against aggregating all of the windows in one pass
+#
+def bench_windows(nsensors=100, days=730, interval=600, seed=123456):
+    df = gen_summary_frame(nsensors, days, interval, seed)
+    windows = ['work', 'out', 'weekend']
+    log.info("Synthetic data: {0} rows, {1} sensors".format(len(df), nsensors))
+
+    def per_window():
+        filtered = {'work': ag.limit_by_hours(df),
+                    'out': df.iloc[df.index.indexer_between_time(*reversed(ag.WORK_HOURS), include_start=True,
+                                                                 include_end=False)],
+                    'weekend': df[df.index.weekday >= 5]}
+        return {w: ag.extract_stats(ag.aggregate(filtered[w], freq='W')) for w in windows}
+
+    def one_pass():
+        aggs = ag.aggregate_windows(df, ag.window_masks(df, windows), freq='W')
+        return {w: ag.extract_stats(aggs[w]) for w in windows}
+
+    old, t_old = timed(per_window)
+    new, t_new = timed(one_pass)
+
+    assert new == old, "Aggregate stats of the windows differ from those of the filtered data"
+
+    log.info("Filtered per window: {0:.2f}s".format(t_old))
+    log.info("One pass:            {0:.2f}s ({1:.1f}x)".format(t_new, t_old / t_new))
+
+
+#
+# Peak memory of the summary tables for a store of months of data (as with --store): loading all of it and
+# aggregating at once, against aggregating the store's months one at a time (aggregate.aggregate_partitions)
+#
+def bench_out_of_core(nsensors=50, days=(91, 365), interval=600):
+    windows = ['work', 'out', 'weekend']
+
+    log.info("{0: >6} {1: >16} {2: >16}".format('Months', 'In memory (MB)', 'By month (MB)'))
+    for d in days:
+        df = gen_summary_frame(nsensors, d, interval)
+        store_dir = tempfile.mkdtemp(prefix='reportgen-')
+
+        try:
+            for name, rows in dh.split_by_id(df).items():
+                st.write_partitions(os.path.join(store_dir, name), rows.drop(columns='Name'))
+            st.write_meta(store_dir, {'version': st.version(), 'sensors': list(df['Name'].cat.categories),
+                                      't_start': str(df.index.min()), 't_end': str(df.index.max())})
+            del df
+
+            def in_memory():
+                df = st.load(store_dir)[0]
+                aggs = ag.aggregate_windows(df, ag.window_masks(df, windows), freq='W')
+                return {w: ag.extract_stats(aggs[w]) for w in windows}
+
+            def by_month():
+                aggs = ag.aggregate_partitions(st.iter_months(store_dir), windows, freq='W')
+                return {w: ag.extract_stats(aggs[w]) for w in windows}
+
+            results, peaks = [], []
+            for func in (in_memory, by_month):
+                tracemalloc.start()
+                results.append(func())
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+            assert results[0] == results[1], "Aggregate stats by month differ from those of all the data"
+            months = len(st.list_months(os.path.join(store_dir, name)))
+
+        finally:
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+        log.info("{0: >6} {1: >16.1f} {2: >16.1f}".format(months, peaks[0] / 1e6, peaks[1] / 1e6))
+
+
+#
+# Weekly figures of a report from the store (as with --store): every row of the report loaded at once vs. each
+# week's rows loaded only to draw its figures (the figures must be identical), with the peak memory of each
+#
+def bench_store_figures(nsensors=10, interval=60, weeks=12):
+    import report   # (imports weasyprint)
+
+    df, dfs, periods = synthetic_weeks(nsensors, interval, weeks)
+    types = [('Temp', dh.TYPE_LABELS['Temp'])]
+    log.info("Synthetic data: {0} rows, {1} sensors, {2} figures".format(len(df), len(dfs), len(periods) * len(types)))
+    store_dir = tempfile.mkdtemp(prefix='reportgen-')
+
+    try:
+        for name, rows in dfs.items():
+            st.write_partitions(os.path.join(store_dir, name), rows.drop(columns='Name'))
+        st.write_meta(store_dir, {'version': st.version(), 'sensors': list(df['Name'].cat.categories),
+                                  't_start': str(df.index.min()), 't_end': str(df.index.max())})
+        del df, dfs
+
+        def loaded():
+            dfs = st.load(store_dir)[1]
+            return report.plot_figures_single_threaded(dfs, periods, types, daily=st.load_daily(store_dir),
+                                                       figure_format='png')
+
+        def by_period():
+            return report.plot_figures_from_store(store_dir, st.read_meta(store_dir)['sensors'], periods, types,
+                                                  daily=st.load_daily(store_dir), figure_format='png')
+
+        results, peaks, times = [], [], []
+        for func in (loaded, by_period):
+            tracemalloc.start()
+            figs, t = timed(func)
+            results.append(figs)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            times.append(t)
+            tracemalloc.stop()
+
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+    log.info("All rows loaded: {0:.2f}s, {1:.1f} MB peak".format(times[0], peaks[0] / 1e6))
+    log.info("By period:       {0:.2f}s, {1:.1f} MB peak".format(times[1], peaks[1] / 1e6))
+
+    assert results[0] == results[1], "Figures of each period loaded from the store differ from those of all the rows"
+
+
+#
+# Incremental ingest into the store (as with --store), a week's data file at a time: one weekly append to the
+# store vs. rebuilding the store from every file, and the stored data vs. the whole history cleaned at once
+# with dh.read_data (which must be identical)
+#
+def bench_ingest(nsensors=10, interval=600, weeks=26):
+    n = weeks * 7 * 24 * 60 * 60 // interval * nsensors
+    units = gen_units(n, nsensors=nsensors, interval=interval)
+    work_dir = tempfile.mkdtemp(prefix='reportgen-')
+
+    try:
+        paths = []
+        for k, part in enumerate(np.array_split(units, weeks)):
+            paths.append(os.path.join(work_dir, 'week{0}.csv'.format(k)))
+            with open(paths[-1], 'w') as f:
+                f.write(units_to_csv(part))
+
+        store_dir = os.path.join(work_dir, 'store')
+        for path in paths[:-1]:
+            st.ingest(store_dir, [path])
+        _, t_append = timed(st.ingest, store_dir, paths[-1:])
+        _, t_rebuild = timed(st.ingest, os.path.join(work_dir, 'rebuilt'), paths)
+
+        stored = st.load(store_dir)[1]
+        cleaned, t_clean = timed(dh.read_data, paths)
+        cleaned = cleaned[1]
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    log.info("Whole history:  {0:.2f}s (dh.read_data, {1} weeks)".format(t_clean, weeks))
+    log.info("Store rebuilt:  {0:.2f}s".format(t_rebuild))
+    log.info("Weekly append:  {0:.2f}s ({1:.1f}x faster than rebuilding)".format(t_append, t_rebuild / t_append))
+
+    assert t_append < t_rebuild, "Appending a week to the store is slower than rebuilding it"
+    assert sorted(stored) == sorted(cleaned)
+    for i in cleaned:
+        pd.testing.assert_frame_equal(stored[i].drop(columns='Name'), cleaned[i].drop(columns='Name'),
+                                      check_dtype=False, check_freq=False, obj=i)
+
+
+#
+# Original (Flask-Table) implementation of ag.tabulate, kept as a reference: a Table class is created for each
+# series and for the period, every call
+#
+def tabulate_reference(stats):
+    from flask_table import NestedTableCol, Table, Col, create_table
+
+    TopTable = create_table('TopTable', base=Table)
+    items = {}
+    for series in stats:
+        t_data = list(map(list, zip(*stats[series])))
+        headers = t_data[0]
+        t_data = [dict(zip(headers, v)) for v in t_data[1:]]
+        items[series.lower() + '_table'] = t_data
+
+        table = create_table(series + 'Table', base=Table)
+        for h in headers:
+            table.add_column(h, Col(h))
+
+        TopTable.add_column(series.lower() + '_table', NestedTableCol(dh.TYPE_LABELS[series], table(t_data).__class__))
+
+    return TopTable([items])
+
+
+#
+# Tabulation of the summary tables of a two-year weekly report (working hours, out of hours and weekends):
+# Flask-Table classes created per call, against the compiled Jinja macros (when Flask-Table is installed)
+#
+def bench_tabulate(nsensors=20, days=730, interval=3600):
+    df = gen_summary_frame(nsensors, days, interval)
+    windows = ['work', 'out', 'weekend']
+    aggs = ag.aggregate_windows(df, ag.window_masks(df, windows), freq='W')
+    stats = {w: ag.extract_stats(aggs[w]) for w in windows}
+    log.info("{0} weeks, {1} windows".format(len(stats['work']), len(windows)))
+    stats = [period for w in windows for period in stats[w].values()]
+
+    new, t_new = timed(lambda: [ag.tabulate(s).__html__() for s in stats])
+
+    try:
+        import flask_table
+    except ImportError:  # No longer a requirement
+        log.warning("Flask-Table isn't installed: skipping the comparison with it")
+        log.info("Jinja macros: {0:.3f}s".format(t_new))
+        return
+
+    old, t_old = timed(lambda: [tabulate_reference(s).__html__() for s in stats])
+
+    assert new == old, "Tables differ from those of Flask-Table"
+
+    log.info("Flask-Table:  {0:.3f}s".format(t_old))
+    log.info("Jinja macros: {0:.3f}s ({1:.1f}x)".format(t_new, t_old / t_new))
+
+
+BENCHMARKS = {
+    'aggregate': bench_aggregate,
+    'binary': bench_binary,
+    'clean': bench_clean,
+    'downsample': bench_downsample,
+    'figure_cache': bench_figure_cache,
+    'figures': bench_figures,
+    'formats': bench_formats,
+    'humidity': bench_humidity,
+    'ingest': bench_ingest,
+    'memory': bench_memory,
+    'monthly': bench_monthly,
+    'out_of_core': bench_out_of_core,
+    'rollup': bench_rollup,
+    'slices': bench_slices,
+    'store_figures': bench_store_figures,
+    'stream': bench_stream,
+    'tabulate': bench_tabulate,
+    'templates': bench_templates,
+    'threads': bench_threads,
+    'windows': bench_windows,
+}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Run benchmarks on synthetic BAX data')
+    parser.add_argument("names", nargs='*',
+                        help="Benchmarks to run: {0} (default: all)".format(", ".join(sorted(BENCHMARKS))))
+    args = parser.parse_args()
+
+    for name in args.names or sorted(BENCHMARKS):
+        log.info("=== {0} ===".format(name))
+        BENCHMARKS[name]()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Persistent on-disk cache of decoded BAX data
+#
+# Each input file is decoded once (see datahandling.readfile) and the parsed, typed DataFrame is
+# stored in Parquet format under a key made from the SHA-1 of the file contents plus a version
+# string. Repeat reports over the same uploads then skip BAXTest / CSV parsing entirely.
+#
+# Entries are named '<sha1>-<version>.parquet'. Bumping the version (e.g. datahandling.PARSER_VERSION)
+# makes old entries unreachable, and evict() removes them along with entries that are too old or
+# push the cache over its size limit (least recently used first). Other caches of files (e.g. rendered
+# figures, see graphing.FIGURE_EXT) are kept in bounds with evict and clear given their extension.
+#
+import os
+import time
+import hashlib
+import threading
+import logging
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+# Default cache location and limits
+CACHE_DIR = os.environ.get('BAX_CACHE_DIR', os.path.join(os.environ['HOME'], '.cache', 'reportgen'))
+CACHE_MAX_BYTES = int(os.environ.get('BAX_CACHE_MAX_BYTES', 2 * 1024 ** 3))   # 2 GiB
+CACHE_MAX_AGE = int(os.environ.get('BAX_CACHE_MAX_AGE', 30 * 24 * 60 * 60))  # 30 days (seconds)
+CACHE_EXT = '.parquet'
+
+# Temporary files (see store) older than this (seconds) were left by a writer which died, and are removed by evict
+TMP_MAX_AGE = 60 * 60
+
+
+#
+# Hash the contents of a file (read in blocks so large archives aren't loaded into memory)
+#
+def file_hash(filename, block_size=1024 * 1024):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+#
+# Return the cache file path for a data file at the given version.
+# Pass the file's hash (file_hash) as key if it's already known, rather than reading the file again
+#
+def cache_path(filename, version, cache_dir=CACHE_DIR, key=None):
+    return os.path.join(cache_dir, "{0}-{1}{2}".format(key or file_hash(filename), version, CACHE_EXT))
+
+
+#
+# Load a cached DataFrame for a data file. Returns None on a cache miss
+#
+def load(filename, version, cache_dir=CACHE_DIR, key=None):
+    path = cache_path(filename, version, cache_dir, key)
+
+    if not os.path.isfile(path):
+        log.debug("Cache miss for {0}".format(filename))
+        return None
+
+    try:
+        df = pd.read_parquet(path)
+    except FileNotFoundError:
+        log.debug("Cache miss for {0} (evicted)".format(filename))
+        return None
+    except (OSError, ValueError) as e:
+        log.warning("Discarding unreadable cache entry {0}: {1}".format(path, e))
+        remove(path)
+        return None
+
+    # Touch the entry so that eviction is least-recently-used (unless another process has just evicted it)
+    try:
+        os.utime(path, None)
+    except FileNotFoundError:
+        pass
+
+    log.debug("Cache hit for {0} ({1})".format(filename, path))
+    return df
+
+
+#
+# Store a decoded DataFrame for a data file, then evict old entries
+#
+def store(filename, df, version, cache_dir=CACHE_DIR, key=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(filename, version, cache_dir, key)
+
+    # Write to a temporary name first so that concurrent readers never see a partial file
+    # (named for the process and thread, as threads of the thread executor may decode the same file)
+    tmp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+    log.debug("Cached {0} as {1}".format(filename, path))
+    evict(version, cache_dir)
+
+
+#
+# Evict cache entries (files ending in ext) which are from another version, older than max_age (seconds),
+# or least recently used once the cache grows beyond max_bytes, along with temporary files left by writers
+# which died. Several processes may evict (and store) at once, so files may vanish while this runs
+#
+def evict(version=None, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE, ext=CACHE_EXT):
+    if not os.path.isdir(cache_dir):
+        return
+
+    now = time.time()
+    entries = []
+    for name in os.listdir(cache_dir):
+        tmp = name.endswith('.tmp')
+        if not tmp and not name.endswith(ext):
+            continue
+
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+
+        if tmp:
+            if now - st.st_mtime > TMP_MAX_AGE:
+                log.debug("Removing stale temporary file {0}".format(name))
+                remove(path)
+            continue
+
+        stale = version is not None and not name.endswith("-{0}{1}".format(version, ext))
+
+        if stale or now - st.st_mtime > max_age:
+            log.debug("Evicting {0}".format(name))
+            remove(path)
+        else:
+            entries.append((st.st_mtime, st.st_size, path))
+
+    # Drop least recently used entries until under the size limit
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        log.debug("Evicting {0} (cache over {1} bytes)".format(os.path.basename(path), max_bytes))
+        remove(path)
+        total -= size
+
+
+#
+# Remove a file, if it's still there (another process may have evicted it first)
+#
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+#
+# Remove every entry from the cache (e.g. after changing the parsing/cleaning logic)
+#
+def clear(cache_dir=CACHE_DIR, ext=CACHE_EXT):
+    if not os.path.isdir(cache_dir):
+        return
+
+    for name in os.listdir(cache_dir):
+        if name.endswith(ext):
+            remove(os.path.join(cache_dir, name))
+
+    log.info("Cleared cache in {0}".format(cache_dir))
@@ -3,12 +3,18 @@
 # 
 import pandas as pd
 import numpy as np
-import multiprocessing
 import time
 import logging
 import mimetypes
 import subprocess
+import functools
 import os
+import re
+
+from collections.abc import Mapping
+
+import cache
+import workers
 
 log = logging.getLogger(__name__)
 
@@ -17,6 +23,10 @@ TOOLS_DIR = os.environ.get('BAX_TOOLS_DIR', os.path.join(os.environ['HOME'], 'ba
 if not os.path.isfile(os.path.join(TOOLS_DIR, "BAXTest")):
     raise FileNotFoundError("BuildAX tooling missing in {}".format(TOOLS_DIR))
 
+# Version of the parsed (pre-cleaning) data layout, used to key the decoded data cache.
+# Bump this whenever df_from_csv / df_from_bin change what they return.
+PARSER_VERSION = 'v3'
+
 
 # Types: a data type. (1, 2) where 1 is the pandas column in the DF and 2 is the series label
 TYPE_LABELS = {
@@ -28,6 +38,46 @@ TYPE_LABELS = {
     'Temp': 'Temperature ˚C'
 }
 
+# Compact column types for decoded BAX data. Sensor names are stored as categoricals (see fix_names)
+BAX_SCHEMA = {
+    'RSSI':          'int8',
+    'Type':          'int8',
+    'SequenceNo':    'uint8',
+    'TransmitPower': 'int8',
+    'Battery':       'uint16',
+    'Humidity':      'float32',
+    'Temp':          'float32',
+    'Light':         'uint16',
+    'PIRCount':      'uint16',
+    'PIREnergy':     'uint16',
+    'Switch':        'uint16'
+}
+
+# Packed 32-byte binary unit, as written by BAXTest in raw output mode (-Mr): a unit header
+# (number, packed date/time, continuation flag) followed by the 22-byte radio packet (address,
+# RSSI, packet type) whose 16-byte payload is a BaxSensorPacket_t for sensor packets
+BAX_UNIT = np.dtype([
+    ('DataNumber',    '<u4'),
+    ('DataTime',      '<u4'),
+    ('Continuation',  'u1'),
+    ('Address',       '<u4'),
+    ('RSSI',          'u1'),
+    ('Type',          'i1'),
+    ('SequenceNo',    'u1'),
+    ('TransmitPower', 'i1'),
+    ('Battery',       '<u2'),
+    ('HumiditySat',   '<u2'),
+    ('Temp',          '<i2'),
+    ('Light',         '<u2'),
+    ('PIRCount',      '<u2'),
+    ('PIREnergy',     '<u2'),
+    ('Switch',        '<u2'),
+    ('Padding',       'u1')
+])
+
+# Packet types carrying (decrypted) sensor readings. Packets which failed decryption have a negated type
+SENSOR_PACKET_TYPES = (1, 2, 3)
+
 
 #
 # Read a BuildAX datafile. Accept:
@@ -36,7 +86,8 @@ TYPE_LABELS = {
 #     * a Pandas DataFrame with corrections applied
 #   * start and end date/time values for the period
 #
-def read_data(input_datafiles: list, exclude_subnet=None, exclude_sensors=None, skip_humidity=False):
+def read_data(input_datafiles: list, exclude_subnet=None, exclude_sensors=None, skip_humidity=False, cache_dir=None,
+              chunksize=None, groupwise=False, executor=None):
 
     if type(input_datafiles) is str:
         raise TypeError("String passed to read_data function instead of list of strings")
@@ -44,22 +95,7 @@ def read_data(input_datafiles: list, exclude_subnet=None, exclude_sensors=None,
     pd.set_option('chained_assignment', None)  # Hush up, SettingWithCopyWarning
 
     start_time = time.time()
-    # Use a generator to concatenate datafiles into a list
-    # Single threaded: 60.73 seconds
-    # df = pd.concat( (dh.readfile(infile) for infile in input_datafiles) )
-
-    # Multithreaded:  19.43 seconds. Winner!
-    p = multiprocessing.Pool()
-    df = pd.concat(p.map(readfile, input_datafiles))
-
-    log.info("Running final sort on merge...")
-    df.sort_index(inplace=True)  # Sort again on merge
-
-    # Lots of subprocesses hanging around: clean 'em up:
-    log.info("Waiting for subprocesses to finish...")
-    p.close()
-    p.join()
-
+    df = read_files(input_datafiles, cache_dir=cache_dir, chunksize=chunksize, executor=executor)
     log.info("+ Data read in {0:.2f}s".format(time.time() - start_time))
 
     start_time = time.time()
@@ -79,26 +115,83 @@ def read_data(input_datafiles: list, exclude_subnet=None, exclude_sensors=None,
     if exclude_subnet is not None:
         drop_subnet(df, exclude_subnet)
 
-    # Split into multiple dataframes by id
-    dfs = split_by_id(df)
+    if groupwise:
+        # Clean a single frame sorted by (Name, DateTime): fixes are applied to all sensors at once,
+        # and per-sensor frames are views into it rather than copies
+        df = sort_by_id(df)
+        df = clean_data({None: df}, skip_humidity)[None]
+        dfs = SensorFrames(df)
+
+    else:
+        # Split into multiple dataframes by id
+        dfs = split_by_id(df)
 
-    # Apply fixes to the data and diff the PIR movement
-    dfs = clean_data(dfs, skip_humidity)
+        # Apply fixes to the data and diff the PIR movement
+        dfs = clean_data(dfs, skip_humidity)
 
-    # Overwrite `df` as dfs contains all the fixes
-    df = pd.concat(dfs.values())
+        # Overwrite `df` as dfs contains all the fixes
+        df = pd.concat(dfs.values())
 
     log.info("+ Data fixes applied in {0:.2f}s".format(time.time() - start_time))
 
     return df, dfs, t_start, t_end
 
 
+#
+# Read a list of BAX files into one time-sorted (uncleaned) DataFrame
+#
+def read_files(input_datafiles: list, cache_dir=None, chunksize=None, executor=None):
+    # Use a generator to concatenate datafiles into a list
+    # Single threaded: 60.73 seconds
+    # df = pd.concat( (dh.readfile(infile) for infile in input_datafiles) )
+
+    # Multithreaded:  19.43 seconds. Winner!
+    # Files are decoded by a shared, capped pool of workers (see workers.py): 'process' (default),
+    # 'thread' (enough for binary files, as BAXTest runs in a subprocess) or 'serial'
+    # With a cache_dir, decoded files are read from (and saved to) the on-disk cache
+    # With a chunksize, CSV is parsed in chunks of that many rows to bound memory use
+    df = pd.concat(workers.map(functools.partial(readfile, cache_dir=cache_dir, chunksize=chunksize),
+                               input_datafiles, executor))
+
+    log.info("Running final sort on merge...")
+    df.sort_index(inplace=True)  # Sort again on merge
+
+    return df
+
+
 #
 # Read a BAX file and save it into Pandas' data structure
+# If cache_dir is given, reuse a previously decoded copy of the file where possible
 #
-def readfile(filename):
+def readfile(filename, cache_dir=None, chunksize=None):
     log.info("Reading data from {0}".format(filename))
 
+    if cache_dir is not None:
+        # The file is hashed once, for both the lookup and (on a miss) storing the decoded data
+        try:
+            key = cache.file_hash(filename)
+        except FileNotFoundError as e:
+            log.error("File not found: {}".format(filename))
+            log.error(e)
+            return None
+
+        df = cache.load(filename, PARSER_VERSION, cache_dir, key)
+        if df is not None:
+            return df
+
+        df = decode_file(filename, chunksize)
+        if df is not None:
+            cache.store(filename, df, PARSER_VERSION, cache_dir, key)
+        return df
+
+    return decode_file(filename, chunksize)
+
+
+#
+# Decode a BAX file using the parser appropriate to its type
+#
+def decode_file(filename, chunksize=None):
+
     # Guess which method to use based on file mimetype
     mtype, _ = mimetypes.guess_type(filename)
     log.debug("Detected MIME: {0}".format(mtype))
@@ -106,9 +199,9 @@ def readfile(filename):
     # Plaintext BAX file
     try:
         if mtype and 'text' in mtype:
-            return df_from_csv(filename)
+            return df_from_csv(filename, chunksize=chunksize)
         else:  # Binary (convert first)
-            return df_from_bin(filename)
+            return df_from_bin(filename, chunksize=chunksize)
     except TypeError as e:
         log.error("File not found: {}".format(filename))
         log.error(e)
@@ -116,8 +209,10 @@ def readfile(filename):
 
 #
 # Call the BAXTest utility (compiled) to read binary files
+# By default BAXTest writes raw binary units which are decoded directly into typed arrays;
+# pass csv=True to have it format CSV text instead (slower: formatted then re-parsed)
 #
-def df_from_bin(filename, decryption_keys=None):
+def df_from_bin(filename, decryption_keys=None, chunksize=None, csv=False):
 
     log.debug("Decoding data file from binary")
     proc = subprocess.Popen([
@@ -127,24 +222,94 @@ def df_from_bin(filename, decryption_keys=None):
         "-Fu",                                           # Format:        units (binary)
         "-Er",                                           # Encoding:      raw binary
         "-Os",                                           # Output:        stdout
-        "-Mc",                                           # Mode (output): CSV
+        "-Mc" if csv else "-Mr",                         # Mode (output): CSV or raw binary units
         "-Pd",                                           # Packets:       decrypted only
         "-I"+decryption_keys if decryption_keys else ''  # Info file:     decryption_keys
     ], stdout=subprocess.PIPE)
 
-    return df_from_csv(proc.stdout)
+    if csv:
+        return df_from_csv(proc.stdout, chunksize=chunksize)
+
+    return df_from_units(proc.stdout, chunksize=chunksize)
+
+
+#
+# Parse a BAX dataframe from a stream of packed binary units (see BAX_UNIT)
+# Pass chunksize (units) to decode the stream in fixed-size blocks
+#
+def df_from_units(stream, chunksize=None):
+
+    log.debug("Reading binary units from stream: {0}".format(stream))
+    block_size = BAX_UNIT.itemsize * chunksize if chunksize else -1
+
+    frames = []
+    while True:
+        buf = stream.read(block_size)
+        if not buf:
+            break
+
+        # Zero-copy view of the buffer as an array of units (ignoring any trailing partial unit)
+        units = np.frombuffer(buf, dtype=BAX_UNIT, count=len(buf) // BAX_UNIT.itemsize)
+        frames.append(units_to_df(units))
+
+        if block_size < 0:
+            break
+
+    df = pd.concat(frames) if frames else units_to_df(np.empty(0, dtype=BAX_UNIT))
+
+    log.debug("Sorting by time index...")
+    df.sort_index(inplace=True, kind='mergesort')
+
+    df.index.names = ['DateTime']
+    return df
+
+
+#
+# Convert an array of binary units into a dataframe matching the columns of df_from_csv
+# (values are converted exactly as BAXTest does when writing CSV)
+#
+def units_to_df(units):
+    # Keep decrypted sensor packets only
+    units = units[np.isin(units['Type'], SENSOR_PACKET_TYPES)]
+
+    # Unpack date/time bitfield: YYYYYYMM MMDDDDDh hhhhmmmm mmssssss (years since 2000)
+    t = units['DataTime'].astype(np.int64)
+    months = ((t >> 26) & 0x3f) * 12 + ((t >> 22) & 0x0f) - 1 + (2000 - 1970) * 12
+    seconds = (((t >> 17) & 0x1f) - 1) * 86400 + ((t >> 12) & 0x1f) * 3600 + ((t >> 6) & 0x3f) * 60 + (t & 0x3f)
+    index = months.astype('datetime64[M]').astype('datetime64[s]') + seconds.astype('timedelta64[s]')
+
+    # Names are formatted once per sensor rather than once per row
+    addresses, inverse = np.unique(units['Address'], return_inverse=True)
+    names = np.array(["{0:08X}".format(a).encode('utf-8') for a in addresses], dtype='S8')
+
+    # Humidity is a fixed point value: integer part in the high byte, fraction (/256) in the low byte
+    humidity = units['HumiditySat']
+
+    return pd.DataFrame({
+        'Name':          names[inverse.reshape(-1)],
+        'RSSI':          (units['RSSI'] >> 1).astype(np.int16) - 128,
+        'Type':          units['Type'],
+        'SequenceNo':    units['SequenceNo'],
+        'TransmitPower': units['TransmitPower'],
+        'Battery':       units['Battery'],
+        'Humidity':      (humidity >> 8) + ((humidity & 0xff).astype(np.int64) * 39 // 100) / 100,
+        'Temp':          units['Temp'],
+        'Light':         units['Light'],
+        'PIRCount':      units['PIRCount'],
+        'PIREnergy':     units['PIREnergy'],
+        'Switch':        units['Switch']
+    }, index=pd.DatetimeIndex(index.astype('datetime64[ns]'), name='DateTime')).astype(BAX_SCHEMA)
 
 
 #
 # Using pandas, parse a BAX dataframe from the given descriptor
+# Pass chunksize (rows) to parse in fixed-size chunks and bound the memory used by the raw text
 #
-def df_from_csv(file_descriptor):
+def df_from_csv(file_descriptor, chunksize=None):
 
     log.debug("Reading CSV from filehandle: {0}".format(file_descriptor))
-    df = pd.read_csv(
+    reader = pd.read_csv(
         filepath_or_buffer=file_descriptor,
-        parse_dates=[['Date', 'Time']],
-        index_col=0,
         names=(
             'Date',
             'Time',
@@ -162,22 +327,65 @@ def df_from_csv(file_descriptor):
             'Switch'
         ),
         dtype={
+            'Date': str,
+            'Time': str,
             'Name':'S8'
-        }
+        },
+        chunksize=chunksize
     )
 
-    # Drop encrypted rows
-    log.debug("Dropping encrypted rows...")
-    df.dropna(inplace=True)
+    if chunksize is None:
+        df = reader
 
-    # Sort to prevent "ValueError: index must be monotonic increasing or decreasing"
-    log.debug("Sorting by time index...")
-    df.sort_index(inplace=True)
+        # Drop encrypted rows
+        log.debug("Dropping encrypted rows...")
+        df.dropna(inplace=True)
+        df = set_time_index(df).astype(BAX_SCHEMA)
+
+        # Sort to prevent "ValueError: index must be monotonic increasing or decreasing"
+        log.debug("Sorting by time index...")
+        df.sort_index(inplace=True)
+
+    else:
+        df = merge_chunks(reader)
 
     df.index.names = ['DateTime']
     return df
 
 
+#
+# Index rows of a parsed CSV frame (or chunk) by the time from its Date and Time columns, which are dropped
+#
+def set_time_index(df):
+    index = pd.DatetimeIndex(pd.to_datetime(df['Date'] + ' ' + df['Time']), name='DateTime')
+    return df.drop(columns=['Date', 'Time']).set_axis(index.as_unit('ns'), axis=0)
+
+
+#
+# Streaming ingestion: drop encrypted rows, narrow dtypes and sort each chunk as it is parsed, so
+# only the (smaller) cleaned chunks are held in memory, then merge the sorted runs into one frame
+#
+def merge_chunks(reader):
+    chunks = []
+    for n, chunk in enumerate(reader):
+        log.debug("Parsed chunk {0} ({1} rows)".format(n, len(chunk)))
+        chunk.dropna(inplace=True)
+        chunk = set_time_index(chunk).astype(BAX_SCHEMA)
+        chunk.sort_index(inplace=True)
+        chunks.append(chunk)
+
+    df = pd.concat(chunks)
+    del chunks
+
+    # Chunks are individually sorted; BAX logs are usually in time order overall, in which case
+    # no further copy is needed. Otherwise mergesort is fast on the pre-sorted runs.
+    if not df.index.is_monotonic_increasing:
+        log.debug("Merging sorted chunks...")
+        df.sort_index(inplace=True, kind='mergesort')
+
+    return df
+
+
 #
 # Read sensor data from CSV file formatted as the following:
 #     SENSORID,SensorName
@@ -227,13 +435,83 @@ def split_by_id(df, id_column='Name'):
     return {n: df.loc[df[id_column] == n, :] for n in df[id_column].unique()}
 
 
+#
+# Sort a (time sorted) dataframe by sensor ID, keeping sensors in order of first appearance
+# (as split_by_id does) and each sensor's rows in time order
+#
+def sort_by_id(df, id_column='Name'):
+    codes, _ = pd.factorize(df[id_column])
+    return df.iloc[np.argsort(codes, kind='mergesort')]
+
+
+#
+# Return a boolean array marking the first row of each run of rows with the same sensor ID
+# (every sensor in a frame sorted with sort_by_id). Frames without the column are one group.
+#
+def group_starts(df, id_column='Name'):
+    first = np.zeros(len(df), dtype=bool)
+    first[:1] = True
+
+    if id_column in df:
+        ids = df[id_column].values
+        first[1:] = ids[1:] != ids[:-1]
+
+    return first
+
+
+#
+# Read-only mapping of sensor ID to dataframe, over a single frame sorted with sort_by_id.
+# Row offsets for each sensor are found once; frames are produced lazily as row slices (views).
+# Supports removing sensors (e.g. threshold_sensors) without touching the underlying frame.
+#
+class SensorFrames(Mapping):
+
+    def __init__(self, df, id_column='Name'):
+        self.df = df
+
+        starts = np.flatnonzero(group_starts(df, id_column)) if len(df) else np.array([], dtype=int)
+        ends = np.append(starts[1:], len(df))
+        names = df[id_column].values[starts]
+
+        self.offsets = {n: (s, e) for n, s, e in zip(names, starts, ends)}
+
+    def __getitem__(self, key):
+        start, end = self.offsets[key]
+        return self.df.iloc[start:end]
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __delitem__(self, key):
+        del self.offsets[key]
+
+    def pop(self, key, *default):
+        if key not in self.offsets and default:
+            return default[0]
+        frame = self[key]
+        del self[key]
+        return frame
+
+
 #
 # Fix dataframe 'Name' labels to ensure all are the same case and datatype
 #
 def fix_names(df, name_column='Name'):
     # Make sure all the names are the same case for comparison!
-    # By using .loc we ensure this happens in-place (not on a copy)
-    df.loc[:, name_column] = df[name_column].apply(lambda name: name.upper().decode("utf-8"))
+    df[name_column] = map_names(df[name_column], lambda name: name.upper().decode("utf-8"))
+
+
+#
+# Apply a function to each unique sensor name (rather than every row) and return the results
+# as a categorical. Names which map to the same result share a category.
+#
+def map_names(names, func):
+    codes, uniques = pd.factorize(names)
+    mapped, categories = pd.factorize(np.array([func(name) for name in uniques], dtype=object))
+    return pd.Categorical.from_codes(mapped[codes], categories)
 
 
 #
@@ -243,56 +521,182 @@ def date_range(df):
     return df.index.min(), df.index.max()
 
 
+#
+# Floor an array of datetime64 values to the start of their period: 'W' (weeks) to Monday 00:00 as
+# datetime64[D] values, 'M' (months) to the month as datetime64[M] values
+#
+def floor_periods(values, freq='W'):
+    if freq == 'W':
+        # Days since the epoch, a Thursday (weekday 3), back to the Monday
+        days = values.astype('datetime64[D]')
+        return days - ((days.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+
+    if freq == 'M':
+        return values.astype('datetime64[M]')
+
+    raise ValueError("Unknown period '{0}': use 'W' (weeks) or 'M' (months)".format(freq))
+
+
+#
+# Time of day of an array of datetime64 values: returns (seconds since midnight, day of the week (Monday is 0)),
+# computed once so that any number of time windows can be picked out with comparisons (see aggregate.window_masks)
+#
+def time_of_day(values):
+    days = values.astype('datetime64[D]')
+    seconds = ((values - days) // np.timedelta64(1, 's')).astype(np.int32)
+    weekdays = ((days.astype(np.int64) + 3) % 7).astype(np.int8)
+    return seconds, weekdays
+
+
+#
+# Find the periods with data in a time index in one pass: each timestamp is floored to the start of its period
+# ('W': Monday 00:00 of its week, 'M': the 1st of its month) and the distinct starts found with np.unique.
+# Returns the periods as (t_start, t_end) tuples (t_end is the last second of the period)
+#
+def get_periods(index, freq='W'):
+    values = index.values
+
+    starts = np.unique(floor_periods(values, freq))
+    starts = pd.DatetimeIndex(starts.astype(values.dtype))
+    ends = (starts + pd.Timedelta('7 days') if freq == 'W' else starts + pd.offsets.MonthBegin()) - pd.Timedelta('1s')
+
+    return list(zip(starts, ends))
+
+
+#
+# Rollups: per-sensor summaries of the cleaned data for each hour ('h') or day ('D'), with columns
+# '<series>_<stat>' for the ROLLUP_STATS of each of the ROLLUP_SERIES. Each is a dict of frames, like dfs,
+# indexed by the start of the hour/day and carrying the sensor's Name. Hours and days without data have no row,
+# and those with only missing values have a count of 0 (and NaN mean, min & max)
+#
+ROLLUP_SERIES = ['Temp', 'Humidity', 'Light', 'PIRDiff', 'RSSI', 'Battery']
+ROLLUP_STATS = ['min', 'mean', 'max', 'count']
+ROLLUP_UNITS = {'h': 'datetime64[h]', 'D': 'datetime64[D]'}
+
+
+#
+# Build rollups of each sensor's cleaned data (e.g. after clean_data), in one pass: rows are split into hours
+# or days where the (time-sorted) timestamps change hour/day, and each statistic reduced with reduceat
+#
+def rollup(dfs, freq='h', series=ROLLUP_SERIES):
+    return {i: rollup_frame(dfs[i], freq, series) for i in dfs if len(dfs[i])}
+
+
+#
+# Rollup of a single sensor's frame (which needn't have a Name column, as with the store's partitions)
+#
+def rollup_frame(df, freq='h', series=ROLLUP_SERIES):
+    if freq not in ROLLUP_UNITS:
+        raise ValueError("Unknown rollup '{0}': use one of {1}".format(freq, ", ".join(ROLLUP_UNITS)))
+
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='stable')
+
+    periods = df.index.values.astype(ROLLUP_UNITS[freq])
+    starts = np.flatnonzero(np.append(True, periods[1:] != periods[:-1]))
+
+    columns = {'Name': df['Name'].values[starts]} if 'Name' in df else {}
+    for s in series:
+        if s not in df:
+            continue
+
+        values = df[s].values
+        if values.dtype.kind == 'f':
+            valid = ~np.isnan(values)
+            count = np.add.reduceat(valid.astype(np.int64), starts)
+            total = np.add.reduceat(np.where(valid, values, 0).astype(np.float64), starts)
+            mins, maxs = np.fmin.reduceat(values, starts), np.fmax.reduceat(values, starts)
+        else:
+            count = np.diff(np.append(starts, len(values)))
+            total = np.add.reduceat(values.astype(np.float64), starts)
+            mins, maxs = np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns.update({s + '_min': mins, s + '_mean': total / count, s + '_max': maxs, s + '_count': count})
+
+    index = pd.DatetimeIndex(periods[starts].astype(df.index.values.dtype), name=df.index.name)
+    return pd.DataFrame(columns, index=index)
+
+
+#
+# Combine rollups into longer periods (e.g. hourly into daily): each sensor's rows are split where the period
+# changes and merged, with counts and sums (mean x count) added, and the min of mins and max of maxes
+#
+def resample_rollup(rollups, freq='D'):
+    return {i: resample_rollup_frame(rollups[i], freq) for i in rollups}
+
+
+#
+# Resample a single sensor's rollup
+#
+def resample_rollup_frame(df, freq='D'):
+    periods = df.index.values.astype(ROLLUP_UNITS[freq])
+    starts = np.flatnonzero(np.append(True, periods[1:] != periods[:-1]))
+
+    columns = {'Name': df['Name'].values[starts]} if 'Name' in df else {}
+    for s in [c[:-len('_count')] for c in df.columns if c.endswith('_count')]:
+        count = np.add.reduceat(df[s + '_count'].values, starts)
+        total = np.add.reduceat(np.nan_to_num(df[s + '_mean'].values * df[s + '_count'].values), starts)
+
+        mins, maxs = df[s + '_min'].values, df[s + '_max'].values
+        reduce_min, reduce_max = (np.fmin, np.fmax) if mins.dtype.kind == 'f' else (np.minimum, np.maximum)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns.update({s + '_min': reduce_min.reduceat(mins, starts), s + '_mean': total / count,
+                            s + '_max': reduce_max.reduceat(maxs, starts), s + '_count': count})
+
+    index = pd.DatetimeIndex(periods[starts].astype(df.index.values.dtype), name=df.index.name)
+    return pd.DataFrame(columns, index=index)
+
+
 #
 # Apply PIR fix to DataFrame:
 # Fast PIR Differencing using Pandas array operations
+# Frames holding several sensors (sorted with sort_by_id) are differenced per sensor
 #
 def diff_pir(dfs, σ=5, pir_threshold=1500):
     # detect trigger above 5σ standard deviations by default
 
     for i in dfs:
-        d = dfs[i].loc[:, ['PIREnergy']]
-
-        # Time deltas
-        df_time = pd.DataFrame(d.index, index=d.index) \
-            .diff().fillna(pd.Timedelta(seconds=0))    \
-            .div(np.timedelta64(1, 's'))               \
-            .astype('int64')
-
-        # Differentiate & fix wrapping at 2^16,
-        # then normalize to 0 and apply scale factor
-        df_diff = d['PIREnergy'].diff()               \
-            .apply(lambda x: x if x > 0 else x+65535) \
-            .astype('float')                          \
-            .div(df_time['DateTime'].astype('float'), axis='index') \
-            .diff()
-
-        # Calculate std. deviation
-        df_std = df_diff.rolling(window=250, center=False).std() * σ
+        index = dfs[i].index.values
+        energy = dfs[i]['PIREnergy'].values.astype('float')
+        first = group_starts(dfs[i])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Time deltas (whole seconds)
+            dt = (np.diff(index, prepend=index[:1]) / np.timedelta64(1, 's')).astype('int64')
+            dt[first] = 0
+
+            # Differentiate & fix wrapping at 2^16,
+            # then normalize to 0 and apply scale factor
+            diff = np.diff(energy, prepend=np.nan)
+            diff[first] = np.nan
+            diff = np.where(diff > 0, diff, diff + 65535) / dt.astype('float')
+
+            diff = np.diff(diff, prepend=np.nan)
+            diff[first] = np.nan
+            df_diff = pd.Series(diff, index=dfs[i].index)
+
+        # Calculate std. deviation (restarting the window for each sensor)
+        if first[1:].any():
+            df_std = df_diff.groupby(np.cumsum(first), sort=False).rolling(window=250, center=False).std().values * σ
+        else:
+            df_std = df_diff.rolling(window=250, center=False).std().values * σ
 
         # Event triggers
-        df_event = (df_diff > df_std).to_frame(name='Event')
+        dfs[i].loc[:, 'Event'] = df_diff.values > df_std
 
-        # Store views into original DataFrame
-        dfs[i].loc[:, 'Event'] = df_event # [df_event['Event'] == True]
-        dfs[i].loc[:, 'PIRDiff'] = df_diff
-        # dfs[i].loc[:,'PIRStd'] = df_std
-
-    # Scrub erroneous values:
-    for i in dfs:
-        # Pull out view into dataframe, where rows are out of threshold, then zero them by updating the
-        # original with a new zero-filled data frame matching those indices
-        out_of_threshold = dfs[i][(dfs[i].PIRDiff > pir_threshold) | (dfs[i].PIRDiff < -pir_threshold)]
-        zeroed_values = pd.DataFrame(0, index=out_of_threshold.index, columns=['PIRDiff'])
-        dfs[i].update(zeroed_values)
+        # Scrub erroneous values: zero those out of threshold
+        dfs[i].loc[:, 'PIRDiff'] = df_diff.mask(df_diff.abs() > pir_threshold, 0)
 
     return dfs
 
 
 #
 # Apply fix to broken values at high humidity
+# (Temp must not have been divided by fix_temp yet)
 #
-def fix_humidity(dfs):
+def fix_humidity(dfs, state=None):
     # Constants from Analog.c
     lookup = np.array([
         [0,  18168,  2560],  # 05˚C
@@ -310,48 +714,88 @@ def fix_humidity(dfs):
 
     # Pre-compute interpolation skew
     # temp2index = np.array([5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60])
-    temp_humid_skews = [(t[-1] - t[0]) / (t[-1] - t[-2]) for t in lookup]
-
-    # Stateful function to determine overflowed values
-    def humidity_needsfix(x):
-        if x[2] < 55 and (humidity_needsfix.broken or np.mean(x[:2]) > 80):
-            humidity_needsfix.broken = True
-            return True
-        humidity_needsfix.broken = False
-        return False
-
-    # static var used for state on humidity_needsfix closure
-    humidity_needsfix.broken = False
-
-    # Conditionally 'fix' incorrect values
-    def fix_humidity_values(d):
-        temp_index = min(max(0, np.floor(d.Temp/5)-1), 11)
-        return min(90 + ((55 - d.Humidity) / temp_humid_skews[temp_index]), 100)
+    temp_humid_skews = (lookup[:, -1] - lookup[:, 0]) / (lookup[:, -1] - lookup[:, -2])
 
+    # Overflow state is kept per sensor, starting clear at each sensor's first row.
+    # A `state` dict (sensor: state) resumes sensors from, and is updated with, their previous state
     for i in dfs:
         df = dfs[i]
+        broken = state.get(i, False) if state is not None else False
 
         # Determine if overflowing with window (this value low, previous values high)
-        needs_fix = df[['Humidity']].rolling(
-            window=5,
-            center=True
-        ).apply(
-            func=humidity_needsfix
-        ).loc[:, 'Humidity']
+        needs_fix, broken = humidity_needsfix(df['Humidity'].values, broken, group_starts(df))
+
+        if state is not None:
+            state[i] = broken
 
         # Apply fix to affected rows using temperature adjustment
-        df.loc[needs_fix > 0, 'Humidity'] = df.loc[needs_fix > 0][['Temp', 'Humidity']] \
-            .apply(fix_humidity_values, axis=1)
+        d = df.loc[needs_fix, ['Temp', 'Humidity']]
+        temp_index = np.floor(d.Temp.values / 5) - 1
+        temp_index = np.where(temp_index > 0, temp_index, 0)     # NaN temperatures use index 0
+        temp_index = np.where(temp_index > 11, 11, temp_index).astype(int)
+
+        df.loc[needs_fix, 'Humidity'] = np.minimum(
+            90 + ((55 - d.Humidity.values) / temp_humid_skews[temp_index]), 100).astype(df['Humidity'].dtype)
 
     return dfs
 
 
+#
+# Find overflowed humidity values: low (< 55) values following high (mean > 80) ones,
+# and every low value after those until the humidity recovers.
+#
+# Evaluated over a centred 5-sample window; windows which are incomplete, contain NaN or
+# span two sensors (where `first` marks each sensor's first row) are skipped and don't change
+# the state. Vectorized as runs of low values: a value needs fixing if a trigger occurred
+# earlier in its run (or the run continues the passed-in state). Runs end at each sensor's
+# first row, so the state is only passed on within a sensor.
+# Returns a boolean mask and the state to carry on with.
+#
+def humidity_needsfix(humidity, broken=False, first=None):
+    h = np.asarray(humidity, dtype=float)
+    n = len(h)
+
+    # Rows with a complete, NaN-free window either side
+    nans = np.concatenate(([0], np.cumsum(np.isnan(h))))
+    valid = np.zeros(n, dtype=bool)
+    if n >= 5:
+        valid[2:n - 2] = (nans[5:] - nans[:-5]) == 0
+
+        # ...from a single sensor (no sensor starting within rows i-1 to i+2)
+        if first is not None:
+            starts = np.concatenate(([0], np.cumsum(first)))
+            valid[2:n - 2] &= (starts[5:] - starts[1:-4]) == 0
+
+    rows = np.flatnonzero(valid)
+    k = np.arange(len(rows))
+
+    low = h[rows] < 55
+    high = (h[rows - 2] + h[rows - 1]) / 2 > 80
+
+    # Position of the latest trigger, and the position before the start of the current run of lows
+    # (or of the current sensor's rows)
+    last_trigger = np.maximum.accumulate(np.where(low & high, k, -1))
+    run_start = np.maximum.accumulate(np.where(low, -1, k))
+
+    if first is not None and len(rows):
+        sensor = np.cumsum(first)[rows]
+        new_sensor = np.concatenate(([True], sensor[1:] != sensor[:-1]))
+        run_start = np.maximum(run_start, np.maximum.accumulate(np.where(new_sensor, k - 1, -1)))
+
+    fix = low & ((last_trigger > run_start) | (broken & (run_start < 0)))
+
+    needs_fix = np.zeros(n, dtype=bool)
+    needs_fix[rows] = fix
+
+    return needs_fix, bool(fix[-1]) if len(fix) else broken
+
+
 #
 # Apply division by 10 to temperature values (in-place)
 #
 def fix_temp(dfs):
     for i in dfs:
-        dfs[i].loc[:, 'Temp'] = dfs[i].loc[:, 'Temp'].div(10)
+        dfs[i]['Temp'] = dfs[i]['Temp'].div(10)
     return dfs
 
 
@@ -359,7 +803,7 @@ def fix_temp(dfs):
 # Scrub erroneous values using light data
 #
 def fix_light(dfs):
-    dfs = {i: dfs[i].drop(dfs[i][dfs[i].Light > 1500].index) for i in dfs}
+    dfs = {i: dfs[i][~(dfs[i].Light > 1500)] for i in dfs}
     return dfs
 
 
@@ -369,7 +813,8 @@ def fix_light(dfs):
 #
 def drop_subnet(df: pd.DataFrame, subnet: str):
     log.debug("Dropping subnet {} from sensor IDs".format(subnet))
-    df.replace({"Name": {"^({0})".format(subnet): ""}}, regex=True, inplace=True)
+    pattern = re.compile("^({0})".format(subnet))
+    df['Name'] = map_names(df['Name'], lambda name: pattern.sub("", name))
 
 
 #
@@ -386,11 +831,12 @@ def drop_sensors(df: pd.DataFrame, sensor_list: list):
 #
 def limit_range(dfs):
     for i in dfs:
-        dfs[i].loc[:, 'Temp'] = dfs[i].loc[:, 'Temp']\
-            .apply(lambda d: d if (d > -500) and (d < 1000) else np.NaN)
-        
-        dfs[i].loc[:, 'Humidity'] = dfs[i].loc[:, 'Humidity']\
-            .apply(lambda d: d if (d > 0.0) and (d < 101.0) else np.NaN)
+        # Replace whole columns, as the scrubbed values may not fit the original (integer) dtype
+        temp = dfs[i]['Temp']
+        dfs[i]['Temp'] = temp.where((temp > -500) & (temp < 1000))
+
+        humidity = dfs[i]['Humidity']
+        dfs[i]['Humidity'] = humidity.where((humidity > 0.0) & (humidity < 101.0))
 
     return dfs
 
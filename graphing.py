@@ -4,10 +4,16 @@ import pandas as pd
 import numpy as np
 import base64
 import calendar
+import hashlib
 import logging
+import os
 import math
+import shutil
+import tempfile
+import threading
+import functools
 
-from mpl_toolkits.axes_grid1 import host_subplot
+from mpl_toolkits.axes_grid1.parasite_axes import host_axes_class_factory
 # from matplotlib.ticker import MaxNLocator
 from pandas.tseries.offsets import MonthEnd, MonthBegin, Week
 from datetime import datetime, timedelta
@@ -15,10 +21,17 @@ from io import BytesIO
 from os import makedirs
 
 import matplotlib as mpl
-# mpl.use('agg')  # Must do this before pyplot import
-import matplotlib.pyplot as plt
+import matplotlib.style
 import mpl_toolkits.axisartist
 
+# Figures are drawn with the Agg canvas directly rather than through pyplot, so that importing this module
+# doesn't select (or probe for) a GUI backend, and so figures can be rendered concurrently from threads
+# (pyplot's current figure/axes are global state)
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import workers
+
 log = logging.getLogger(__name__)
 
 
@@ -38,7 +51,9 @@ graph.colors = ["#1f77b4", "#aec7e8", "#ff7f0e", "#ffbb78", "#2ca02c", "#98df8a"
 # Set appropriate matplotlib parameters
 #
 def set_mpl_params():
-    mpl.style.use('seaborn-bright')  # 'fivethirtyeight')
+    # Seaborn styles were renamed in matplotlib 3.6
+    style = 'seaborn-v0_8-bright' if 'seaborn-v0_8-bright' in mpl.style.available else 'seaborn-bright'
+    mpl.style.use(style)  # 'fivethirtyeight')
     mpl.rcParams['lines.linewidth'] = 1
     mpl.rcParams['figure.figsize'] = (8, 12)  # (3,2)
     mpl.rcParams['axes.titlesize'] = 'large'
@@ -51,18 +66,49 @@ def set_mpl_params():
     mpl.rcParams['font.size'] = 10.0
 
 
+# Figure output formats, and their MIME types (for embedding as data URIs):
+#     svg         Vector graphics throughout
+#     svg-raster  Vector axes and text, with the plotted lines rasterized (at `dpi`)
+#     png         Raster image (at `dpi`)
+FIGURE_FORMATS = {
+    'svg': 'image/svg+xml',
+    'svg-raster': 'image/svg+xml',
+    'png': 'image/png',
+}
+
+# Rendered figures can be kept in a figure cache directory (see `figure_cache` in weekly_graph), named by a
+# fingerprint of everything drawn and '-<FIGURE_VERSION><FIGURE_EXT>'. Bump the version when changes to the
+# graph functions change their output, making old entries unreachable (cache.evict then removes them)
+FIGURE_VERSION = 'g1'
+FIGURE_EXT = '.fig'
+
+
 #
 # Output a plot to buffer using savefig
+# dpi defaults to rcParams['savefig.dpi'], and only affects raster output
+# Returns the figure base64 encoded, or the path when `handle` is a file path
 #
-def save_figure(fig, handle):
+def save_figure(fig, handle, fmt='svg', dpi=None):
+
+    if fmt not in FIGURE_FORMATS:
+        raise ValueError("Unknown figure format '{0}': use one of {1}".format(fmt, ", ".join(FIGURE_FORMATS)))
+
+    # Set (or unset, as a template may have been saved as svg-raster before) the lines' rasterization
+    for ax in fig.axes:
+        for line in ax.lines:
+            line.set_rasterized(fmt == 'svg-raster')
 
     fig.savefig(
         handle,
-        format='svg',
+        format='png' if fmt == 'png' else 'svg',
+        dpi=dpi or mpl.rcParams['savefig.dpi'],
         transparent=True,
         bbox_inches='tight',
         pad_inches=0.1)
 
+    if isinstance(handle, str):
+        return handle
+
     handle.seek(0)
     return base64.b64encode(handle.getvalue()).decode('utf-8').replace('\n', '')
 
@@ -77,31 +123,283 @@ def get_sorted_labels(handles, labels):
     return zip(*hl)
 
 
+#
+# Fingerprint of a figure: a hash of its parameters, the matplotlib settings and the data it plots
+#
+def figure_fingerprint(params, x_data, y_data):
+    sha = hashlib.sha1()
+    sha.update(repr(params).encode('utf-8'))
+    sha.update(repr(sorted((k, v) for k, v in mpl.rcParams.items() if not k.startswith('backend'))).encode('utf-8'))
+
+    for x, y in zip(x_data, y_data):
+        for values in (np.ascontiguousarray(x), np.ascontiguousarray(y)):
+            sha.update("{0}{1}".format(values.dtype.str, len(values)).encode('utf-8'))
+            sha.update(values.view(np.uint8))
+
+    return sha.hexdigest()
+
+
+#
+# Path of a figure in the figure cache
+#
+def cached_figure_path(figure_cache, fingerprint):
+    return os.path.join(figure_cache, "{0}-{1}{2}".format(fingerprint, FIGURE_VERSION, FIGURE_EXT))
+
+
+#
+# Return a figure from the figure cache as the graph functions do (written to figure_file and its path
+# returned, or base64 encoded), or None on a cache miss
+#
+def load_figure(figure_cache, fingerprint, figure_file=None):
+    path = cached_figure_path(figure_cache, fingerprint)
+
+    try:
+        if figure_file:
+            shutil.copyfile(path, figure_file)
+            output = figure_file
+        else:
+            with open(path, 'rb') as f:
+                output = base64.b64encode(f.read()).decode('utf-8')
+
+        # Touch the entry so that eviction is least-recently-used
+        os.utime(path, None)
+
+    except FileNotFoundError:
+        return None
+
+    log.debug("Figure cache hit for {0}".format(fingerprint))
+    return output
+
+
+#
+# Store a figure (as returned by the graph functions) in the figure cache. Call cache.evict
+# (with FIGURE_VERSION and FIGURE_EXT) once a report's figures are done, to keep the cache in bounds
+#
+def store_figure(figure_cache, fingerprint, output, figure_file=None):
+    os.makedirs(figure_cache, exist_ok=True)
+    path = cached_figure_path(figure_cache, fingerprint)
+
+    # Write to a temporary name first so that concurrent readers never see a partial file
+    tmp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+    if figure_file:
+        shutil.copyfile(figure_file, tmp_path)
+    else:
+        with open(tmp_path, 'wb') as f:
+            f.write(base64.b64decode(output))
+    os.replace(tmp_path, path)
+
+
+#
+# Per-sensor index of day boundaries, found once (with searchsorted) and shared by all figures in a report.
+# Each subplot's x/y data is then a slice of the sensor's index and column arrays, without copying.
+# Periods which don't start and end on a day boundary are looked up directly.
+# With `daily` rollups of the data (dh.rollup, keyed as dfs), period ranges are read from those instead.
+#
+class SliceIndex:
+    def __init__(self, dfs, daily=None):
+        self.names = list(dfs.keys())
+        self.daily = daily
+        self.frames = [dfs[i] for i in self.names]
+        self.index = [df.index for df in self.frames]
+        self.columns = {}  # series: list of per-sensor arrays, filled on first use
+        self.ranges = {}   # (series, freq): per-period min & max tables, filled on first use
+
+        # An index may be shared by threads rendering at once: caches are filled under a lock
+        # (re-entrant, as period_ranges fills columns through values)
+        self.lock = threading.RLock()
+
+        # Day boundaries spanning all the data
+        ends = [(ix[0], ix[-1]) for ix in self.index if len(ix)]
+        if ends:
+            t_start, t_end = min(e[0] for e in ends), max(e[1] for e in ends)
+            self.bounds = pd.date_range(t_start.normalize(), t_end.normalize() + pd.Timedelta('1 day'), freq='D')
+        else:
+            self.bounds = pd.DatetimeIndex([])
+
+        # Row positions of each boundary (first row at or after, and first row after) for every sensor
+        self.left = [ix.searchsorted(self.bounds, 'left') for ix in self.index]
+        self.right = [ix.searchsorted(self.bounds, 'right') for ix in self.index]
+
+    #
+    # Row positions [lo, hi) of each sensor's data from start to end (inclusive, as with .loc[start:end])
+    #
+    def positions(self, start, end):
+        a, b = self.bounds.get_indexer([pd.Timestamp(start), pd.Timestamp(end)])
+
+        return [(left[a] if a >= 0 else ix.searchsorted(start, 'left'),
+                 right[b] if b >= 0 else ix.searchsorted(end, 'right'))
+                for ix, left, right in zip(self.index, self.left, self.right)]
+
+    #
+    # Return lists (one item per sensor) of x (DatetimeIndex) and y (array) data from start to end
+    #
+    def get(self, series, start, end):
+        pos = self.positions(start, end)
+        x_data = [ix[lo:hi] for ix, (lo, hi) in zip(self.index, pos)]
+        y_data = [values[lo:hi] for values, (lo, hi) in zip(self.values(series), pos)]
+
+        return x_data, y_data
+
+    #
+    # Return each sensor's array of values for a series
+    #
+    def values(self, series):
+        with self.lock:
+            if series not in self.columns:
+                self.columns[series] = [df[series].values for df in self.frames]
+            return self.columns[series]
+
+    #
+    # Return tables of the min and max of a series for each period (rows, grouped with pd.Grouper(freq))
+    # and sensor (columns). Computed once per series and frequency, from daily minima & maxima (as periods
+    # of a week or longer are made of whole days): those of the daily rollup, or found with reduceat over
+    # the day boundaries
+    #
+    def period_ranges(self, series, freq):
+        with self.lock:
+            if (series, freq) not in self.ranges:
+                self.ranges[(series, freq)] = self.find_ranges(series, freq)
+            return self.ranges[(series, freq)]
+
+    #
+    # Find the tables of period_ranges (without caching them)
+    #
+    def find_ranges(self, series, freq):
+        days = self.bounds[:-1]
+        mins, maxs = {}, {}
+
+        for name, values, left in zip(self.names, self.values(series), self.left):
+            if self.daily is not None and name in self.daily and series + '_min' in self.daily[name]:
+                mins[name] = self.daily[name][series + '_min'].reindex(days)
+                maxs[name] = self.daily[name][series + '_max'].reindex(days)
+                continue
+
+            lo, hi = left[:-1], left[1:]
+            dtype = values.dtype if values.dtype.kind == 'f' else np.float64
+            daily_min = np.full(len(days), np.nan, dtype=dtype)
+            daily_max = daily_min.copy()
+
+            # Each reduceat segment runs to the next index given, so pass only days with data
+            # (the bounds span all of the data, so the last segment ends with the last day)
+            has_data = hi > lo
+            if has_data.any():
+                daily_min[has_data] = np.fmin.reduceat(values, lo[has_data])
+                daily_max[has_data] = np.fmax.reduceat(values, lo[has_data])
+
+            mins[name] = pd.Series(daily_min, index=days)
+            maxs[name] = pd.Series(daily_max, index=days)
+
+        # 'M' (month end) isn't accepted as a frequency alias by newer pandas: pass the offset instead
+        grouper = pd.Grouper(freq=MonthEnd() if freq == 'M' else freq)
+        return (pd.DataFrame(mins).groupby(grouper).min(),
+                pd.DataFrame(maxs).groupby(grouper).max())
+
+
+#
+# Downsampling methods for dense series: each returns the positions of the points to keep
+#
+DOWNSAMPLE_METHODS = ('minmax', 'lttb')
+
+
+#
+# Reduce each sensor's x/y data (lists, as from SliceIndex.get) for a subplot spanning start to end
+# to at most max_points points per line, or two per pixel column of the axes if that's fewer
+#
+def downsample(ax, x_data, y_data, start, end, max_points, method='minmax'):
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError("Unknown downsampling method '{0}': use one of {1}"
+                         .format(method, ", ".join(DOWNSAMPLE_METHODS)))
+
+    n = min(max_points, 2 * int(ax.get_window_extent().width))
+    t_start, t_end = pd.Timestamp(start).value, pd.Timestamp(end).value
+
+    for j, (x, y) in enumerate(zip(x_data, y_data)):
+        if len(x) <= n:
+            continue
+
+        # Time as ns since the epoch (the index may be stored in another unit)
+        t = x.values.astype('datetime64[ns]').view('int64')
+        keep = minmax_points(t, y, n, t_start, t_end) if method == 'minmax' else lttb_points(t, y, n)
+        x_data[j], y_data[j] = x[keep], y[keep]
+
+    return x_data, y_data
+
+
+#
+# Min/max per bucket: split the period into n/2 equal spans of time (one per pixel column, at most)
+# and keep the lowest and highest point in each, so peaks and troughs are always drawn. NaNs are dropped
+#
+def minmax_points(t, y, n, t_start, t_end):
+    finite = np.flatnonzero(~np.isnan(y))
+    if len(finite) == 0:
+        return finite
+
+    buckets = max(n // 2, 1)
+    bucket = np.clip((t[finite] - t_start) * buckets // max(t_end - t_start, 1), 0, buckets - 1)
+
+    # Order by bucket then value: the first and last of each bucket are its min and max
+    by_value = np.lexsort((y[finite], bucket))
+    order = finite[by_value]
+    starts = np.flatnonzero(np.diff(bucket[by_value], prepend=-1))
+    ends = np.append(starts[1:], len(order)) - 1
+
+    return np.unique(np.concatenate((order[starts], order[ends])))
+
+
+#
+# Largest-Triangle-Three-Buckets (Steinarsson, 2013): keep the first and last points, and from each
+# of n-2 equal-count buckets in between the point forming the largest triangle with the previously kept
+# point and the average of the next bucket. Preserves the visual shape of the line. NaNs are dropped
+#
+def lttb_points(t, y, n):
+    finite = np.flatnonzero(~np.isnan(y))
+    if len(finite) <= max(n, 2):
+        return finite
+
+    x = (t[finite] - t[finite[0]]).astype(float)
+    v = y[finite].astype(float)
+    size = len(finite)
+
+    # Bucket edges: n-2 buckets over points 1 .. size-2, then the last point as a bucket of its own
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    counts = np.diff(np.append(edges, size))
+    avg_x = np.add.reduceat(x, edges) / counts
+    avg_y = np.add.reduceat(v, edges) / counts
+
+    keep = np.empty(n, dtype=int)
+    keep[0], keep[-1] = 0, size - 1
+
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - avg_x[i + 1]) * (v[lo:hi] - v[a]) - (x[a] - x[lo:hi]) * (avg_y[i + 1] - v[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+
+    return finite[keep]
+
+
 #
 # Manually calculate range of y-axis data
 # This is a workaround for a bug: Setting xlim with plt.sublplots(..., sharey=True)
 # causes the yaxis to center on 0 if plotted 2 plots with no y_data (0 range). Therefore,
 # restrict the y-axis ticks manually using set_yticks and calculate the range pre-plot:
 #
-def get_yaxis_range(dfs, series, t_end, freq='M', pad_pc=10):
+def get_yaxis_range(dfs, series, t_end, freq='M', pad_pc=10, slices=None):
 
     log.debug("End: {} ".format(t_end))
 
-    rng = list()
-    for frame in dfs:
-        try:
-            mini = dfs[frame].groupby(pd.Grouper(freq=freq))[series].agg(['min']).rename(columns={'min': series})
-            log.debug("indices: {}".format(mini.index))
-            mini = mini.loc[str(t_end.date())][series]
-
-            maxi = dfs[frame].groupby(pd.Grouper(freq=freq))[series].agg(['max']).rename(columns={'max': series})
-            maxi = maxi.loc[str(t_end.date())][series]
-
-            rng.append((mini, maxi))
+    # Min & max for every period are found once per series, and shared by all figures using `slices`
+    mins, maxs = (slices or SliceIndex(dfs)).period_ranges(series, freq)
+    period = pd.Timestamp(t_end.date())
 
-        except KeyError as e:
+    rng = list()
+    for frame in mins.columns:
+        if period not in mins.index or np.isnan(mins.at[period, frame]):
             log.warning("Skipped {0} in range as there was no data for {1}".format(frame, t_end.date()))
-            log.debug("The error was: {}".format(e))
+            continue
+
+        rng.append((mins.at[period, frame], maxs.at[period, frame]))
 
     rng = list(zip(*rng))
 
@@ -124,6 +422,91 @@ def plot_weekly(t):
     return weekly_graph(*t)
 
 
+#
+# Path of the file for figure `index` of a series in figure_dir (see `figure_file` in weekly_graph)
+#
+def figure_path(figure_dir, series, index, fmt='svg'):
+    return os.path.join(figure_dir, "{0}-{1:04d}.{2}".format(series, index, 'png' if fmt == 'png' else 'svg'))
+
+
+#
+# Plot figures for every (series, period) in worker processes and return them as a nested list:
+# figs[series][period], as report.plot_figures_single_threaded does. Other kwargs go to the graph functions.
+# With a figure_dir, workers write the figures to files there and their paths are returned instead.
+#
+# The data is published once (columns in `types` only) to a memory-mapped file in shared memory,
+# and each worker maps in just the slice for its period, rather than having the whole of `dfs`
+# pickled to it with every task. Figures are rendered on the shared process pool (see workers.run),
+# at most max_workers at a time: its workers are started by a forkserver (or spawned, where there's
+# no forkserver), so they don't inherit a fork of a GUI backend, and render with Agg.
+#
+def plot_figures_shared(dfs, periods, types, plot_months=False, legend_cols=3, max_workers=None, figure_dir=None,
+                        **kwargs):
+    # Workers render with the (already tuned) matplotlib parameters of this process
+    params = worker_params()
+    fmt = kwargs.get('figure_format', 'svg')
+
+    handoff_dir = tempfile.mkdtemp(prefix='reportgen-', dir=workers.HANDOFF_DIR)
+    try:
+        layout = workers.share_frames(dfs, [t for t, _ in types], handoff_dir)
+
+        figs = workers.run([
+            functools.partial(plot_shared, layout, params, *typestring, *p, plot_months=plot_months,
+                              legend_cols=legend_cols, **kwargs,
+                              figure_file=figure_path(figure_dir, typestring[0], i, fmt)
+                              if figure_dir is not None else None)
+            for typestring in types for i, p in enumerate(periods)
+        ], max_workers)
+
+    finally:
+        shutil.rmtree(handoff_dir, ignore_errors=True)
+
+    return [figs[i:i + len(periods)] for i in range(0, len(figs), len(periods))]
+
+
+# Weekly figure templates kept by each rendering worker process, for the figures (data layout) it last rendered
+worker_templates = {'layout': None, 'templates': {}}
+
+
+#
+# The matplotlib parameters of this process, for workers to render with (see init_worker)
+#
+def worker_params():
+    return {k: v for k, v in mpl.rcParams.items() if not k.startswith('backend')}
+
+
+#
+# Set up a figure rendering worker process: Agg backend, with the given matplotlib parameters
+#
+def init_worker(params):
+    mpl.use('agg')
+    mpl.rcParams.update(params)
+
+
+#
+# Plot one weekly or monthly figure from data published with workers.share_frames, with the given
+# matplotlib parameters (workers of the shared pool may have rendered for other reports before)
+#
+def plot_shared(layout, params, series, y_label, t_start, t_end, plot_months=False, legend_cols=3, **kwargs):
+    init_worker(params)
+
+    # Graphs are clamped to whole weeks (and months include the weeks overlapping them),
+    # so map a week either side of the period
+    margin = pd.Timedelta('8 days')
+    dfs = workers.attach_frames(layout, t_start - margin, t_end + margin)
+
+    if plot_months:
+        return monthly_graph(dfs, series, y_label, t_start, t_end, **kwargs)
+
+    # Templates are kept while rendering the figures of one report, then dropped
+    if worker_templates['layout'] != layout['path']:
+        close_templates(worker_templates['templates'])
+        worker_templates['layout'] = layout['path']
+
+    return weekly_graph(dfs, series, y_label, t_start, t_end, legend_cols=legend_cols,
+                        templates=worker_templates['templates'], **kwargs)
+
+
 #
 # Plot a graph. Variable number of axes, linked (or not). Lots of lovely options.
 #
@@ -155,8 +538,15 @@ def multiaxis_graph(x_data, y_data, **kwargs):
 
     offset.multiplier = 60
 
-    plt.figure()
-    host = host_subplot(111, axes_class=mpl_toolkits.axisartist.Axes)
+    if savefig:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+    else:
+        import matplotlib.pyplot as plt  # Showing the figure interactively needs pyplot (and a GUI backend)
+        fig = plt.figure()
+
+    # (host_subplot would import pyplot, even when given the figure)
+    host = fig.add_subplot(111, axes_class=host_axes_class_factory(mpl_toolkits.axisartist.Axes))
     host.axis["top"].toggle(all=False)
 
     # Iterate series
@@ -214,7 +604,7 @@ def multiaxis_graph(x_data, y_data, **kwargs):
             ax.set_ylabel(label)
 
     if title:
-        plt.suptitle(title)
+        fig.suptitle(title)
 
     if x_label:
         host.set_xlabel(x_label)
@@ -223,9 +613,9 @@ def multiaxis_graph(x_data, y_data, **kwargs):
         host.set_ylabel(y_label)
 
     if legend:
-        plt.legend()
+        fig.gca().legend()
 
-    plt.draw()
+    fig.canvas.draw()
 
     if savefig:
         if type(savefig) is str:
@@ -234,13 +624,37 @@ def multiaxis_graph(x_data, y_data, **kwargs):
         else:
             handle = BytesIO()
 
-        return save_figure(plt, handle)
+        return save_figure(fig, handle)
     else:
+        import matplotlib.pyplot as plt
         plt.show()
 
 
+#
+# Hide the first tick on an axis, showing the others (which may have been hidden on a previous figure)
+#
+def hide_first_tick(axis):
+    ticks = axis.get_major_ticks()
+    for tick in ticks:
+        tick.set_visible(True)
+    ticks[0].set_visible(False)
+
+
+#
+# Close the figures kept in a templates dict (passed to weekly_graph as `templates`) once a report is done
+#
+def close_templates(templates):
+    for fig, _ in templates.values():
+        fig.clf()
+    templates.clear()
+
+
 #
 # Plot a series as weekly views using subplots
+# Pass a dict as `templates` to reuse figures between calls: the subplot grid, styling and legend are set
+# up once for each layout and set of sensors, and only the data, limits and labels change per figure
+# Pass a path as `figure_file` to write the figure there (and return the path) rather than return it base64 encoded
+# Pass a directory as `figure_cache` to reuse a figure rendered before from the same data and parameters
 #
 def weekly_graph(dfs: dict,
                  series,
@@ -266,6 +680,14 @@ def weekly_graph(dfs: dict,
     colors = kwargs.pop('colors', graph.colors)
     spines = kwargs.pop('spines', {'top': True, 'bottom': True, 'left': True, 'right': True})
     pad_pc = kwargs.pop('pad_pc', 10)
+    slices = kwargs.pop('slices', None) or SliceIndex(dfs)
+    max_points = kwargs.pop('max_points', None)
+    method = kwargs.pop('downsample', 'minmax')
+    fmt = kwargs.pop('figure_format', 'svg')
+    dpi = kwargs.pop('dpi', None)
+    figure_file = kwargs.pop('figure_file', None)
+    figure_cache = kwargs.pop('figure_cache', None)
+    templates = kwargs.pop('templates', None)
 
     # freq DOW must match DOW for t_end + 1 day (unless t_end time == 00:00:00)
     # Clamp range: always display the whole week regardless of the data passed
@@ -273,21 +695,45 @@ def weekly_graph(dfs: dict,
     t_end = t_start + pd.Timedelta('7 days') - pd.Timedelta('1 microsecond')
 
     # 'W' alone is a synonym for 'W-SUN'
-    rng = get_yaxis_range(dfs, series, t_end, freq='W', pad_pc=pad_pc)
-
-    # Eight subplots, returned as a 2-d array
-    fig, axarr = plt.subplots(rows, cols)  # , sharey=True)
-    fig.subplots_adjust(hspace=0, wspace=0)
-    fig.autofmt_xdate()
-
-    # Reformat axarr for 1x8 or 8x1 plots
-    if rows == 1:
-        axarr = [axarr, []]
-    if cols == 1:
-        axarr = [[ax] for ax in axarr]
+    rng = get_yaxis_range(dfs, series, t_end, freq='W', pad_pc=pad_pc, slices=slices)
+
+    # Skip drawing a figure that's in the cache (the last cell runs to midnight at the end of the week)
+    if figure_cache is not None:
+        params = ('weekly', series, y_label, t_start, cols, legend_cols, grid, spline_alpha, txt_alpha, sort_legend,
+                  tuple(colors), tuple(spines.items()), tuple(dfs.keys()), rng, max_points, method, fmt, dpi)
+        fingerprint = figure_fingerprint(params, *slices.get(series, t_start, t_start + pd.Timedelta('7 days')))
+
+        output = load_figure(figure_cache, fingerprint, figure_file)
+        if output is not None:
+            return output
+
+    # Reuse a figure already styled for this layout and set of sensors (only the data, limits and
+    # labels are updated), or create a new one and style it
+    key = ('weekly', cols, legend_cols, grid, spline_alpha, txt_alpha, sort_legend,
+           tuple(colors), tuple(spines.items()), tuple(dfs.keys()))
+    new = templates is None or key not in templates
+
+    if new:
+        # Eight subplots, returned as a 2-d array
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        axarr = fig.subplots(rows, cols)  # , sharey=True)
+        fig.subplots_adjust(hspace=0, wspace=0)
+        fig.autofmt_xdate()
+
+        # Reformat axarr for 1x8 or 8x1 plots
+        if rows == 1:
+            axarr = [axarr, []]
+        if cols == 1:
+            axarr = [[ax] for ax in axarr]
+
+        if templates is not None:
+            templates[key] = (fig, axarr)
+    else:
+        fig, axarr = templates[key]
 
     # Commented out as without sharey=True different ticks are sometimes generated
-    #plt.gca().yaxis.set_major_locator(mpl.ticker.MaxNLocator(prune='both'))
+    #fig.gca().yaxis.set_major_locator(mpl.ticker.MaxNLocator(prune='both'))
 
     # Start plotting at cell 1 (cell zero is legend)
     i = 1
@@ -296,9 +742,12 @@ def weekly_graph(dfs: dict,
         row, col = (i // cols, i % cols)
         ax = axarr[row][col]
 
-        # Pandas Data
-        x_data = [dfs[i].loc[start:end, ].index for i in dfs]
-        y_data = [dfs[i].loc[start:end, series].values for i in dfs]
+        # Slices of each sensor's data (x: DatetimeIndex, y: values)
+        x_data, y_data = slices.get(series, start, end)
+
+        # Limit points per line to what the subplot can show
+        if max_points:
+            x_data, y_data = downsample(ax, x_data, y_data, start, end, max_points, method)
 
         # Ignore days with one value (e.g. fetch interface returns 23:59:58 from the previous day)
         # if sum( [len(x) for x in x_data] ) <= len( x_data ):
@@ -309,7 +758,10 @@ def weekly_graph(dfs: dict,
 
         for j in range(0, len(y_data)):
             # log.debug(str(j) + ',' + str(len(x_data)) + ',' + str(len(y_data)) + ',' + str(row) + ',' + str(col))
-            ax.plot(x_data[j], y_data[j], color=colors[j % len(colors)])
+            if new:
+                ax.plot(x_data[j], y_data[j], color=colors[j % len(colors)])
+            else:
+                ax.lines[j].set_data(x_data[j], y_data[j])
 
         # Force 24h graph time period
         ax.set_autoscale_on(False)
@@ -322,29 +774,32 @@ def weekly_graph(dfs: dict,
                              start.date().strftime('%d %b')),
             loc='left', x=0.05, y=0.80)
 
-        # Define the date format for ticks
-        date_form = mpl.dates.DateFormatter("%H:%M")
-        ax.xaxis.set_major_formatter(date_form)
+        if new:
+            # Define the date format for ticks
+            date_form = mpl.dates.DateFormatter("%H:%M")
+            ax.xaxis.set_major_formatter(date_form)
 
-        if grid:
-            ax.grid(True, which="both", alpha=0.25)
+            if grid:
+                ax.grid(True, which="both", alpha=0.25)
 
         # Turn off y-axis tick labels in columns that aren't leftmost:
         if col > 0:
             [i.set_visible(False) for i in ax.yaxis.get_ticklabels()]
 
-        # Set spines for this grid box (the outside lines)
-        for sp in spines.keys():
-            ax.spines[sp].set_visible(spines[sp])
-            ax.spines[sp].set_alpha(spline_alpha)
+        if new:
+            # Set spines for this grid box (the outside lines)
+            for sp in spines.keys():
+                ax.spines[sp].set_visible(spines[sp])
+                ax.spines[sp].set_alpha(spline_alpha)
 
         # Set text/label alpha
         [l.set_alpha(txt_alpha) for l in ax.xaxis.get_ticklabels()]
         [l.set_alpha(txt_alpha) for l in ax.yaxis.get_ticklabels()]
 
         # Set first tick label on y axis invisible, except on last row:
+        # (ticks are reused when the figure is, so show the rest again)
         if row < 3 and cols > 1:
-            ax.yaxis.get_major_ticks()[0].set_visible(False)
+            hide_first_tick(ax.yaxis)
 
         i += 1
 
@@ -357,7 +812,7 @@ def weekly_graph(dfs: dict,
     if cols > 1:
         axarr[0][0].set_ylim(rng[0], rng[1])
         [l.set_alpha(txt_alpha) for l in axarr[0][0].yaxis.get_ticklabels()]
-        axarr[0][0].yaxis.get_major_ticks()[0].set_visible(False)
+        hide_first_tick(axarr[0][0].yaxis)
 
     # Fine-tune figure
     # Set labels on left column plots y-axis
@@ -365,6 +820,10 @@ def weekly_graph(dfs: dict,
     for row in range(0, rows):
         axarr[row][0].set_ylabel(y_label)
 
+        # Tick parameters are kept when the figure is reused
+        if not new:
+            continue
+
         for col in range(0, cols):
             axarr[row][col].tick_params(
                 axis='both',   # changes apply to both axis
@@ -379,37 +838,43 @@ def weekly_graph(dfs: dict,
             if row == 3:
                 axarr[row][col].tick_params(labelbottom=True)
 
-    # Get the handles and labels for a legend
-    handles = axarr[0][1 if cols > 1 else 0].lines
-    labels = list(dfs.keys())
+    # The legend (of the same lines) is kept when the figure is reused
+    if new:
+        # Get the handles and labels for a legend
+        handles = axarr[0][1 if cols > 1 else 0].lines
+        labels = list(dfs.keys())
 
-    # sort legend by labels
-    if sort_legend:
-        handles, labels = get_sorted_labels(handles, labels)
+        # sort legend by labels
+        if sort_legend:
+            handles, labels = get_sorted_labels(handles, labels)
 
-    # Plot a legend inside the upper leftmost figure
-    leg = plt.figlegend(
-        handles,
-        labels,
-        loc='upper left',
-        bbox_to_anchor=(0.13, -0.12, 1, 1),  # (left, bottom, width, height)
-        bbox_transform=plt.gcf().transFigure,
-        ncol=legend_cols,
-        labelspacing=0.5,
-        columnspacing=0.25,
-        markerscale=2,
-        frameon=False)
+        # Plot a legend inside the upper leftmost figure
+        leg = fig.legend(
+            handles,
+            labels,
+            loc='upper left',
+            bbox_to_anchor=(0.13, -0.12, 1, 1),  # (left, bottom, width, height)
+            bbox_transform=fig.transFigure,
+            ncol=legend_cols,
+            labelspacing=0.5,
+            columnspacing=0.25,
+            markerscale=2,
+            frameon=False)
 
-    plt.setp(leg.get_lines(), linewidth=1.5)  # the legend linewidth
+        for line in leg.get_lines():
+            line.set_linewidth(1.5)  # the legend linewidth
 
-    b64 = save_figure(fig, handle=BytesIO())
+    output = save_figure(fig, handle=figure_file or BytesIO(), fmt=fmt, dpi=dpi)
 
-    # Explicitly close plot to stop ipython complaining about memory
-    # (this also stops ipython displaying plots, but who cares)
-    fig.clf()
-    plt.close()
+    # Explicitly clear the figure to free memory sooner
+    # Templates are kept for the next figure, until close_templates
+    if templates is None:
+        fig.clf()
 
-    return b64
+    if figure_cache is not None:
+        store_figure(figure_cache, fingerprint, output, figure_file)
+
+    return output
 
 
 #
@@ -437,8 +902,7 @@ def monthly_graph(dfs: dict,
     t_end = t_start + MonthEnd()
 
     # Calculate date range and required cells
-    date_range = pd.date_range(t_start - pd.Timedelta('7 days'), t_end,
-                               freq='W-MON', normalize=True, closed=None, label='left')
+    date_range = pd.date_range(t_start - pd.Timedelta('7 days'), t_end, freq='W-MON', normalize=True)
     cells = len(date_range)
     rows = cells // cols
     legend_cols = len(dfs) // legend_rows + 1 if legend_rows else 6
@@ -448,11 +912,32 @@ def monthly_graph(dfs: dict,
     hspace = kwargs.pop('hspace', .1)
     wspace = kwargs.pop('wspace', 0)
     pad_pc = kwargs.pop('pad_pc', 10)
-
-    rng = get_yaxis_range(dfs, series, t_end, pad_pc=pad_pc)
+    slices = kwargs.pop('slices', None) or SliceIndex(dfs)
+    max_points = kwargs.pop('max_points', None)
+    method = kwargs.pop('downsample', 'minmax')
+    fmt = kwargs.pop('figure_format', 'svg')
+    dpi = kwargs.pop('dpi', None)
+    figure_file = kwargs.pop('figure_file', None)
+    figure_cache = kwargs.pop('figure_cache', None)
+
+    rng = get_yaxis_range(dfs, series, t_end, pad_pc=pad_pc, slices=slices)
+
+    # Skip drawing a figure that's in the cache
+    if figure_cache is not None:
+        params = ('monthly', series, y_label, t_start, cols, legend_rows, grid, spline_alpha, txt_alpha, sort_legend,
+                  tuple(colors), tuple(spines.items()), hspace, wspace, tuple(dfs.keys()), rng, max_points, method,
+                  fmt, dpi)
+        fingerprint = figure_fingerprint(params, *slices.get(series, date_range[0],
+                                                             date_range[-1] + pd.Timedelta('7 days')))
+
+        output = load_figure(figure_cache, fingerprint, figure_file)
+        if output is not None:
+            return output
 
     # Subplots, returned as a 2-d array
-    fig, axarr = plt.subplots(rows, cols)
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    axarr = fig.subplots(rows, cols)
     fig.subplots_adjust(hspace=hspace, wspace=wspace)
     fig.autofmt_xdate()
 
@@ -463,7 +948,7 @@ def monthly_graph(dfs: dict,
         axarr = np.array([[ax] for ax in axarr])
 
     # Commented out as without sharey=True different ticks are sometimes generated
-    # plt.gca().yaxis.set_major_locator(MaxNLocator(prune='both'))
+    # fig.gca().yaxis.set_major_locator(MaxNLocator(prune='both'))
 
     log.info("{0: <8} - {1} to {2}".format(series, str(t_start), str(t_end)))
 
@@ -476,9 +961,12 @@ def monthly_graph(dfs: dict,
         log.debug("{},{}".format(row, col))
         ax = axarr[row][col]
 
-        # Pandas Data
-        x_data = [dfs[i].loc[start:end, ].index for i in dfs]
-        y_data = [dfs[i].loc[start:end, series].values for i in dfs]
+        # Slices of each sensor's data (x: DatetimeIndex, y: values)
+        x_data, y_data = slices.get(series, start, end)
+
+        # Limit points per line to what the subplot can show
+        if max_points:
+            x_data, y_data = downsample(ax, x_data, y_data, start, end, max_points, method)
 
         cardinality = sum([len(y) for y in y_data])
         log.info("Graphing {0} in cell {1} @{2},{3} ({4} values)"
@@ -519,9 +1007,11 @@ def monthly_graph(dfs: dict,
             xs = sorted(ax.get_xticks())
             wd = pd.DatetimeIndex(pd.date_range(start=start, end=end, freq='D')).map(pd.Timestamp.weekday).values[:-1]
 
+            # (matplotlib needs a label for every tick: leave the ticks past the last day blank)
+            labels = [weekday_map[d] for d in wd][:len(xs)]
             ax.set_xticks(xs)
             ax.set_xticks([], minor=True)
-            ax.set_xticklabels([weekday_map[d] for d in wd])
+            ax.set_xticklabels(labels + [''] * (len(xs) - len(labels)))
 
         # Fine-tune figure
         # Set labels on left column plots y-axis
@@ -572,7 +1062,7 @@ def monthly_graph(dfs: dict,
         labels,
         loc='upper left',
         bbox_to_anchor=(0.12, -.06, 1, 1),  # (left, bottom, width, height)
-        bbox_transform=plt.gcf().transFigure,
+        bbox_transform=fig.transFigure,
         ncol=legend_cols,
         labelspacing=0.5,
         columnspacing=0.5,
@@ -580,15 +1070,18 @@ def monthly_graph(dfs: dict,
         frameon=False)
 
     if leg is not None:
-        plt.setp(leg.get_lines(), linewidth=1.5)  # the legend linewidth
+        for line in leg.get_lines():
+            line.set_linewidth(1.5)  # the legend linewidth
 
-    b64 = save_figure(fig, handle=BytesIO())
+    output = save_figure(fig, handle=figure_file or BytesIO(), fmt=fmt, dpi=dpi)
 
-    # Explicitly close plot to stop ipython complaining about memory
+    # Explicitly clear the figure to free memory sooner
     fig.clf()
-    plt.close()
 
-    return b64
+    if figure_cache is not None:
+        store_figure(figure_cache, fingerprint, output, figure_file)
+
+    return output
 
 
 #
@@ -27,13 +27,13 @@ def process(input_datafiles, output_file, **kwargs):
     df, dfs, t_start, t_end = read_data(input_datafiles)
     log.info("Data files range from {0} to {1}".format(t_start, t_end))
 
-    sensor_stats(dfs)
+    sensor_stats({k: len(dfs[k]) for k in dfs})
     
     log.info("Sorting data to write out...")
 
     out = pd.concat([dfs[d] for d in dfs])
     out.sort_index(inplace=True)
-    out.fillna(0, inplace=True)
+    out.fillna({c: 0 for c in out.columns if c != 'Name'}, inplace=True)  # Name is categorical
     out.to_csv(output_file, header=True)
 
     log.info("Done! Output written to {}".format(output_file))
@@ -7,13 +7,21 @@ import time
 import base64
 import jinja2
 import logging
+import shutil
+import pathlib
+import tempfile
 import mimetypes
 import weasyprint
+import functools
+import numpy as np
 import pandas as pd
 
 import datahandling as dh
 import graphing as gr
 import aggregate as ag
+import cache as ca
+import store as st
+import workers
 from graphing import weekly_graph, monthly_graph
 
 # Tell me what you're doing, scripts :)
@@ -21,6 +29,9 @@ log = logging.getLogger(__name__)
 
 template_dir = os.path.join(sys.path[0], "templates")
 
+# Render figures in parallel for reports with at least this many
+PARALLEL_FIGURES = int(os.environ.get('BAX_PARALLEL_FIGURES', 4))
+
 
 #
 # Generate a report PDF from an input BAX datafile list
@@ -42,30 +53,94 @@ def report(input_datafiles, **kwargs):
     drop_subnet = kwargs.pop('drop_subnet', None)
     drop_sensors = kwargs.pop('drop_sensors', None)
     skip_humidity = kwargs.pop('skip_humidity', False)
+    cache_dir = kwargs.pop('cache_dir', None)
+    chunksize = kwargs.pop('chunksize', None)
+    groupwise = kwargs.pop('groupwise', False)
+    executor = kwargs.pop('executor', None)
+    store_dir = kwargs.pop('store_dir', None)
+    t_from = kwargs.pop('start', None)
+    t_to = kwargs.pop('end', None)
+    max_points = kwargs.pop('max_points', None)
+    downsample = kwargs.pop('downsample', 'minmax')
+    figure_format = kwargs.pop('figure_format', 'svg')
+    dpi = kwargs.pop('dpi', None)
+    pdf_workers = kwargs.pop('pdf_workers', None)
+    hours = kwargs.pop('hours', None) or ['work']
+
+    # Rendered figures are cached alongside decoded data, and reused when their data and settings are unchanged
+    figure_cache = os.path.join(cache_dir, 'figures') if cache_dir is not None else None
+
+    # Drop previously decoded data and figures (e.g. after changing parsing logic)
+    if kwargs.pop('clear_cache', False):
+        ca.clear(cache_dir or ca.CACHE_DIR)
+        ca.clear(os.path.join(cache_dir or ca.CACHE_DIR, 'figures'), ext=gr.FIGURE_EXT)
+
+    # Cap the number of workers (shared by every report in this process)
+    max_workers = kwargs.pop('workers', None)
+    if max_workers is not None:
+        workers.set_max_workers(max_workers)
 
     #
     # Perform data read-in using the datahandling module (which applies the necessary corrections)
-    df, dfs, t_start, t_end = dh.read_data(input_datafiles, exclude_subnet=drop_subnet, exclude_sensors=drop_sensors, skip_humidity=skip_humidity)
+    if store_dir is not None:
+        # Ingest new files only
+        if input_datafiles:
+            st.ingest(store_dir, input_datafiles, exclude_subnet=drop_subnet, exclude_sensors=drop_sensors,
+                      skip_humidity=skip_humidity, cache_dir=cache_dir, chunksize=chunksize, executor=executor)
+
+        # The requested period isn't loaded as a whole: sensors' rows are counted from the partitions' time index,
+        # the aggregate tables are made out of core, from the stored hourly rollups a month at a time, daily
+        # rollups give the report's periods and the ranges of the graphs' axes, and each period's rows are only
+        # loaded to draw its figures (see plot_figures_from_store)
+        rows = st.count_rows(store_dir, t_from, t_to)
+        if not rows:
+            raise ValueError("No data in store {0} from {1} to {2}"
+                             .format(store_dir, t_from or 'the start', t_to or 'the end'))
+
+        df, dfs = None, None
+        t_start, t_end = st.data_range(st.open_store(store_dir), t_from, t_to)
+        hourly, months = None, st.iter_months(store_dir, t_from, t_to, rollups=True)
+        daily = st.load_daily(store_dir, t_from, t_to)
+        index = pd.DatetimeIndex(np.concatenate([d.index.values for d in daily.values()]))
+    else:
+        df, dfs, t_start, t_end = dh.read_data(input_datafiles, exclude_subnet=drop_subnet,
+                                               exclude_sensors=drop_sensors, skip_humidity=skip_humidity,
+                                               cache_dir=cache_dir, chunksize=chunksize, groupwise=groupwise,
+                                               executor=executor)
+
+        # Hourly rollups summarise the data for the aggregate tables, and daily ones the ranges of the graphs' axes
+        hourly, months = dh.rollup(dfs), None
+        daily = dh.resample_rollup(hourly, 'D')
+        index = df.index
     log.info("Data files range from {0} to {1}".format(t_start, t_end))
     # log.debug("File list: " + '\n'.join(input_datafiles))
 
-    # Custom sensor naming?
+    # Custom sensor naming? (From the store, names are applied to the rows of each period as they're loaded)
+    name_map = None
     if names:
         name_map = dh.read_sensor_names(names)      # Read in names
-        dfs = dh.apply_sensor_names(dfs, name_map)  # Apply names
+        if dfs is not None:
+            dfs = dh.apply_sensor_names(dfs, name_map)  # Apply names
+        daily = dh.apply_sensor_names(daily, name_map)
         log.debug(name_map)
 
-    # Threshold sensors
-    dfs = dh.threshold_sensors(dfs, threshold)
+    # Threshold sensors (by their row counts, from the store)
+    if dfs is not None:
+        dfs = dh.threshold_sensors(dfs, threshold)
+        rows = {k: len(dfs[k]) for k in dfs}
+    else:
+        for k in [k for k in rows if rows[k] <= threshold]:
+            log.warning("Dropping sensor {0}: {1} packets <= threshold {2}".format(k, rows[k], threshold))
+            del rows[k]
 
     # Print statistics
-    sensor_stats(dfs)
+    sensor_stats(rows)
 
     # Set sensible matplotlib defaults for plotting graphs
     gr.set_mpl_params()
 
     # Generate graphs using matplotlib for the following types:
-    periods = get_month_range(df) if plot_months else get_week_range(df)
+    periods = get_month_range(index) if plot_months else get_week_range(index)
 
     if series:
         s_list = ['Temp', 'Humidity', 'Light', 'PIRDiff', 'RSSI', 'Battery']
@@ -74,121 +149,229 @@ def report(input_datafiles, **kwargs):
     log.debug(types)
     log.info("Generating graphs for period {0} to {1}".format(periods[0][0], periods[-1:][0][0]))
 
-    start_time = time.time()
-
-    figs = plot_figures_single_threaded(dfs, periods, types, plot_months, legend_cols=1 if names else 3)
-
-    log.info("+ Graphs generated in {0:.2f}s".format(time.time() - start_time))
-
-    # Format graphs and metadata into a data structure for the jinja2 templater:
-    # Generates a structure of the form: to_plot[week][series][data]
-    # e.g. to_plot[0][0]['label'] == 'Temperature ˚C'
-    to_render = [
-        [
-            {
-                'type':     t,
-                'label':    l,
-                'data':     d[i],
-                't_start':  w[0].date(),
-                't_end':    w[1].date()
-            } for i, w in enumerate(periods)
-        ] for t, l, d in zip(*zip(*types), figs)
-    ]
-
-    # Generate summary aggregate tables for end of report:
-    table_list = perform_aggregation(df, 'M' if plot_months else 'W')
-
-    # Read in the map
-    loc_map = None
-    if map_filename is not None:
-        loc_map = read_map(map_filename)
-        log.debug('map type is ' + str(loc_map[1]))
-
-    # Render the jinja template
-    output = render_template(
-        periods=periods,
-        t_start=periods[0][0].date(),
-        t_end=periods[-1:][0][1].date(),
-        to_render=to_render,
-        drop_sensors=drop_sensors,
-        location=location,
-        description=description,
-        plot_months=plot_months,
-        date_format='%B %Y' if plot_months else '%Y-%m-%d',
-        table_list=table_list,
-        map=dict(zip(['b64', 'mime'], loc_map)) if map_filename is not None and loc_map[1] is not None else None
-    )
-
-    # Debug log first 150 chars of html:
-    log.debug(output[:150].replace('\n', ' '))
-
+    # Figures (and the report html) are written to files in a working directory as they're produced,
+    # rather than held in memory, so memory use doesn't grow with the length of the report
+    work_dir = tempfile.mkdtemp(prefix='reportgen-')
     try:
-        write_file(dest_file, output, output_pdf)
-
-    except FileNotFoundError as e:
-        log.error(e)
-        log.info("Retrying with default filename 'reportgen_output' in home directory")
-
-        write_file(os.path.expanduser(default_filename), output, output_pdf)
+        start_time = time.time()
+
+        # Render in parallel when there are enough figures to make up for starting the workers
+        parallel = workers.MAX_WORKERS > 1 and len(periods) * len(types) >= PARALLEL_FIGURES
+
+        if store_dir is not None:
+            figs = plot_figures_from_store(store_dir, list(rows), periods, types, plot_months,
+                                           legend_cols=1 if names else 3, parallel=parallel, t_from=t_from, t_to=t_to,
+                                           name_map=name_map, daily=daily, max_points=max_points,
+                                           downsample=downsample, figure_format=figure_format, dpi=dpi,
+                                           figure_dir=work_dir, figure_cache=figure_cache)
+        elif parallel:
+            figs = plot_figures_multi_threaded(dfs, periods, types, plot_months, legend_cols=1 if names else 3,
+                                               max_points=max_points, downsample=downsample,
+                                               figure_format=figure_format, dpi=dpi, figure_dir=work_dir,
+                                               figure_cache=figure_cache)
+        else:
+            figs = plot_figures_single_threaded(dfs, periods, types, plot_months, legend_cols=1 if names else 3,
+                                                max_points=max_points, downsample=downsample,
+                                                figure_format=figure_format, dpi=dpi, figure_dir=work_dir,
+                                                figure_cache=figure_cache, daily=daily)
+
+        log.info("+ Graphs generated in {0:.2f}s".format(time.time() - start_time))
+
+        if figure_cache is not None:
+            ca.evict(gr.FIGURE_VERSION, figure_cache, ext=gr.FIGURE_EXT)
+
+        # Format graphs and metadata into a data structure for the jinja2 templater:
+        # Generates a structure of the form: to_plot[week][series][data]
+        # e.g. to_plot[0][0]['label'] == 'Temperature ˚C'
+        to_render = [
+            [
+                {
+                    'type':     t,
+                    'label':    l,
+                    'file':     d[i],
+                    't_start':  w[0].date(),
+                    't_end':    w[1].date()
+                } for i, w in enumerate(periods)
+            ] for t, l, d in zip(*zip(*types), figs)
+        ]
+
+        # Generate summary aggregate tables for end of report:
+        table_list = perform_aggregation(df, 'M' if plot_months else 'W', hourly, hours, months)
+
+        # Read in the map
+        loc_map = None
+        if map_filename is not None:
+            loc_map = read_map(map_filename)
+            log.debug('map type is ' + str(loc_map[1]))
+
+        # Variables for the jinja templates
+        context = dict(
+            periods=periods,
+            t_start=periods[0][0].date(),
+            t_end=periods[-1:][0][1].date(),
+            to_render=to_render,
+            drop_sensors=drop_sensors,
+            location=location,
+            description=description,
+            plot_months=plot_months,
+            date_format='%B %Y' if plot_months else '%Y-%m-%d',
+            figure_mime=gr.FIGURE_FORMATS[figure_format],
+            table_list=table_list,
+            windows=[ag.WINDOWS[w] for w in hours],
+            map=dict(zip(['b64', 'mime'], loc_map))
+            if map_filename is not None and loc_map[1] is not None else None
+        )
+
+        if output_pdf and pdf_workers is not None and pdf_workers > 1:
+            # Render the report in sections, to PDFs written in parallel and then merged
+            sections = render_sections(embed_figures=False, **context)
+            write = lambda f: write_pdf_sections(f, sections, pdf_workers)
+        else:
+            # Render the jinja template to a file: figures are linked for WeasyPrint to read from disk,
+            # or embedded (one at a time, as the html is written) for a standalone HTM report
+            htm_file = os.path.join(work_dir, 'report.htm')
+            render_template(htm_file, embed_figures=not output_pdf, **context)
+            write = lambda f: write_file(f, htm_file, output_pdf)
+
+        start_time = time.time()
+
+        try:
+            write(dest_file)
+
+        except FileNotFoundError as e:
+            log.error(e)
+            log.info("Retrying with default filename 'reportgen_output' in home directory")
+
+            dest_file = os.path.expanduser(default_filename)
+            write(dest_file)
+
+        log.info("+ {0} written in {1:.2f}s ({2:.0f} kB, {3} figures)".format(
+            'PDF' if output_pdf else 'HTM', time.time() - start_time, os.path.getsize(dest_file) / 1e3, figure_format))
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
 
 #
 # Plot figures multi-threaded and return as a nested list data structure
 #
-# This still appears to be bugged and can run slower than single-threaded...
-# Current hypothesis is that the dataframe is being copied in memory, so for large data sets this kills performance :(
+# This used to run slower than single-threaded, as `dfs` was pickled to the workers for every figure.
+# The sensor data is now published once to shared memory and each worker maps in only the week/month
+# it renders (see graphing.plot_figures_shared).
 #
-# Plotting graphs this way gives an error if the matplotlib backend is 'macosx':
+# Workers are started by a forkserver rather than forked from this process, avoiding the crash with
+# the 'macosx' backend:
 #   Break on __THE_PROCESS_HAS_FORKED_AND_YOU_CANNOT_USE_THIS_COREFOUNDATION_FUNCTIONALITY___YOU_MUST_EXEC__() to debug.
 #
-# ...or on newer OSX:
-#  +[NSView initialize] may have been in progress in another thread when fork() was called. We cannot safely call it or
-#   ignore it in the fork() child process. Crashing instead. Set a breakpoint on objc_initializeAfterForkError to debug.
-#
-def plot_figures_multi_threaded(dfs, periods, types, plot_months=False, **kwargs):
-
-    import multiprocessing
+def plot_figures_multi_threaded(dfs, periods, types, plot_months=False, legend_cols=3, **kwargs):
 
-    log.info("Rendering using multiprocessing")
+    log.info("Rendering using {0} processes".format(min(workers.MAX_WORKERS, len(periods) * len(types))))
 
-    # Generate arguments:
-    series_args = [
-        (dfs, *typestring, *p)
-        for p in periods
-        for typestring in types]
-
-    # [print(s[1:]) for s in series_args]
-
-    # Plot in multiple processes
-    p = multiprocessing.Pool(processes=12)
-    plot_function = monthly_graph if plot_months else weekly_graph
-    figs = p.starmap(plot_function, series_args)
-
-    return [figs]
+    return gr.plot_figures_shared(dfs, periods, types, plot_months, legend_cols=legend_cols, **kwargs)
 
 
 #
 # Plot figures single-threaded and return as a nested list data structure
+# With a figure_dir, figures are written to files there and their paths are returned instead
 # Single-threaded: 46.72s
 #
-def plot_figures_single_threaded(dfs, periods, types, plot_months=False, legend_cols=3):
+def plot_figures_single_threaded(dfs, periods, types, plot_months=False, legend_cols=3, figure_dir=None, daily=None,
+                                 **kwargs):
 
     log.info("Rendering on single thread")
 
+    # Day boundaries in each sensor's data are found once for all figures (with axis ranges from the
+    # daily rollups, if given), and weekly figures reuse a styled template
+    slices = gr.SliceIndex(dfs, daily)
+    templates = {}
+
+    def figure_file(typestring, i):
+        if figure_dir is not None:
+            return gr.figure_path(figure_dir, typestring[0], i, kwargs.get('figure_format', 'svg'))
+
     # Arguments are expanded to match function signature:
     # *typestring: (series, y_label) from types array
     # *period: (t_start, t_end)
-    return [[
-        monthly_graph(dfs, *typestring, *p) if plot_months else
-        weekly_graph(dfs, *typestring, *p, legend_cols=legend_cols)
-        for p in periods
+    figs = [[
+        monthly_graph(dfs, *typestring, *p, slices=slices, figure_file=figure_file(typestring, i), **kwargs)
+        if plot_months else
+        weekly_graph(dfs, *typestring, *p, legend_cols=legend_cols, slices=slices, templates=templates,
+                     figure_file=figure_file(typestring, i), **kwargs)
+        for i, p in enumerate(periods)
     ] for typestring in types]
 
+    gr.close_templates(templates)
+    return figs
+
 
 #
-# Write report to file
+# Plot figures from the store (for the given sensor IDs) and return them as the other plot_figures functions do.
+# Each period's rows, and a week either side, are loaded from the store only to draw the period's figures, so
+# memory use is bounded by a period's data rather than the report's. Periods are drawn on the shared process pool
+# when `parallel`, otherwise in this process, reusing weekly templates
 #
-def write_file(dest_file, output, output_pdf=True):
+def plot_figures_from_store(store_dir, sensors, periods, types, plot_months=False, legend_cols=3, parallel=False,
+                            t_from=None, t_to=None, name_map=None, daily=None, figure_dir=None, **kwargs):
+
+    if parallel:
+        log.info("Rendering from {0} using {1} processes".format(store_dir, min(workers.MAX_WORKERS, len(periods))))
+    else:
+        log.info("Rendering from {0} on single thread".format(store_dir))
+
+    params = gr.worker_params() if parallel else None
+    templates = None if parallel else {}
+    fmt = kwargs.get('figure_format', 'svg')
+    margin = pd.Timedelta('8 days')
+
+    tasks = []
+    for i, (t_start, t_end) in enumerate(periods):
+        start, end = t_start - margin, t_end + margin
+        if t_from is not None:
+            start = max(start, pd.Timestamp(t_from))
+        if t_to is not None:
+            end = min(end, pd.Timestamp(t_to))
+
+        tasks.append(functools.partial(
+            plot_store_period, store_dir, sensors, types, t_start, t_end, start, end, name_map=name_map,
+            daily={k: d.loc[start:end] for k, d in daily.items()} if daily is not None else None,
+            plot_months=plot_months, legend_cols=legend_cols, params=params, templates=templates,
+            figure_files=[gr.figure_path(figure_dir, t[0], i, fmt) if figure_dir is not None else None for t in types],
+            **kwargs))
+
+    figs = workers.run(tasks) if parallel else [task() for task in tasks]
+
+    if templates:
+        gr.close_templates(templates)
+    return [list(f) for f in zip(*figs)]
+
+
+#
+# Load a period's rows (from start to end) from the store and plot its figure of each of types.
+# In a worker process, pass the matplotlib parameters to render with (see graphing.worker_params)
+#
+def plot_store_period(store_dir, sensors, types, t_start, t_end, start, end, name_map=None, daily=None,
+                      plot_months=False, legend_cols=3, params=None, templates=None, figure_files=None, **kwargs):
+    if params is not None:
+        gr.init_worker(params)
+
+    dfs = st.load(store_dir, start, end, sensors=sensors)[1]
+    if name_map is not None:
+        dfs = dh.apply_sensor_names(dfs, name_map)
+
+    slices = gr.SliceIndex(dfs, daily)
+    return [
+        monthly_graph(dfs, *typestring, t_start, t_end, slices=slices, figure_file=figure_file, **kwargs)
+        if plot_months else
+        weekly_graph(dfs, *typestring, t_start, t_end, legend_cols=legend_cols, slices=slices, templates=templates,
+                     figure_file=figure_file, **kwargs)
+        for typestring, figure_file in zip(types, figure_files or [None] * len(types))
+    ]
+
+
+#
+# Write report (rendered to htm_file) to file
+#
+def write_file(dest_file, htm_file, output_pdf=True):
 
     log.info("Writing to {1} file {0}".format(dest_file, ('PDF' if output_pdf else 'HTM')))
 
@@ -197,74 +380,115 @@ def write_file(dest_file, output, output_pdf=True):
         print_css = weasyprint.CSS(os.path.join(template_dir, "report.css"))
         # debug_css = weasyprint.CSS(os.path.join(template_dir, "debug.css"))
 
-        htm = weasyprint.HTML(string=output, base_url='.')
+        htm = weasyprint.HTML(filename=htm_file, base_url='.')
         htm.write_pdf(target=dest_file, zoom=2, stylesheets=[print_css])  # , debug_css])
 
     else:
         # write to HTML:
-        with open(dest_file, 'w+') as t:
-            t.write(output)
+        shutil.copyfile(htm_file, dest_file)
+
+
+#
+# Write report sections to one PDF file, rendering up to max_workers sections at a time on the shared process pool
+# (see workers.run) and merging them in order. Each section starts on a new page
+#
+# WeasyPrint lays out a document on a single thread, so a year of weekly figures took minutes in one
+# write_pdf call. The sections (HTML from render_sections) are passed to the workers as files, and each
+# section PDF is written back to a file, to save pickling embedded figures to and from the workers.
+#
+def write_pdf_sections(dest_file, sections, max_workers):
+    import pypdf
+
+    log.info("Writing to PDF file {0} in {1} sections on {2} processes".format(
+        dest_file, len(sections), min(max_workers, workers.MAX_WORKERS, len(sections))))
+
+    css_file = os.path.join(template_dir, "report.css")
+    handoff_dir = tempfile.mkdtemp(prefix='reportgen-', dir=workers.HANDOFF_DIR)
+    try:
+        paths = []
+        for i, section in enumerate(sections):
+            path = os.path.join(handoff_dir, "{0:05d}".format(i))
+            with open(path + '.htm', 'w') as t:
+                t.write(section)
+            paths.append(path)
+
+        workers.run([functools.partial(write_pdf_section, path + '.htm', path + '.pdf', css_file) for path in paths],
+                    max_workers)
+
+        # Merge in page order (keeping each section's bookmarks)
+        merged = pypdf.PdfWriter()
+        for path in paths:
+            merged.append(path + '.pdf')
+
+        with open(dest_file, 'wb') as t:
+            merged.write(t)
+
+    finally:
+        shutil.rmtree(handoff_dir, ignore_errors=True)
+
+
+#
+# Write one report section (an HTML file) to a PDF file, as write_file does for the whole report
+#
+def write_pdf_section(htm_file, pdf_file, css_file):
+    print_css = weasyprint.CSS(css_file)
+
+    htm = weasyprint.HTML(filename=htm_file, base_url='.')
+    htm.write_pdf(target=pdf_file, zoom=2, stylesheets=[print_css])
 
 
 #
 # Perform aggregation and return list of tables to render
 #
-def perform_aggregation(df, freq):
+def perform_aggregation(df, freq, hourly=None, hours=('work',), partitions=None):
     log.info("Generating summary tables")
 
-    # Limit to values during working hours:
-    df = ag.limit_by_hours(df)
+    if partitions is not None:
+        # Aggregate partitions of the data (e.g. months from the store) one at a time, and merge them
+        aggs = ag.aggregate_partitions(partitions, hours, freq=freq)
+
+    else:
+        # Summarise the hourly rollups (the same aggregates, from far fewer rows) rather than the samples, if given
+        if hourly:
+            df = pd.concat(hourly.values())
 
-    # Perform multi-column aggregation and
-    #  extract interesting stats from the aggregate table
-    stats = ag.extract_stats(ag.aggregate(df, freq=freq))
+        # Perform multi-column aggregation for each window of hours (e.g. working hours) in one pass
+        aggs = ag.aggregate_windows(df, ag.window_masks(df, hours), freq=freq)
 
-    # Iterate each month and tabulate each stats set
-    table_list = [ag.tabulate(stats[month]) for month in list(stats.keys())]
+    # Extract interesting stats from the aggregate tables
+    stats = {w: ag.extract_stats(aggs[w]) for w in hours if w in aggs}
 
-    return zip(list(stats.keys()), table_list)
+    # Tabulate each period's stats, with a table for each window side by side
+    periods = sorted(set().union(*stats.values()))
+    return [(period, [(ag.WINDOWS[w][0], ag.tabulate(stats[w][period])) for w in stats if period in stats[w]])
+            for period in periods]
 
 
 #
-# Print some statistics about sensors, and drop those with only one packet
+# Print some statistics about sensors: the number of rows (packets) of each
 #
-def sensor_stats(dfs):
+def sensor_stats(rows):
 
     log.info(" ID      | Packets ")
     log.info("=========|=========")
-    for k, df in dfs.items():
-        log.info("{0:8} | {1}".format(k[:8], len(dfs[k])))
+    for k, n in rows.items():
+        log.info("{0:8} | {1}".format(k[:8], n))
 
-    return dfs
+    return rows
 
 
 #
-# Generate date range of weeks inclusive of start and end
+# Generate date range of weeks (starting Mondays) with data (times in index), inclusive of start and end
 #
-def get_week_range(df):
-    weeks = [
-        (w, w + pd.DateOffset(days=6) + pd.Timedelta('23:59:59'))
-        for w in list(df.groupby(pd.Grouper(freq='W-MON', closed='left', label='left')).groups)
-    ]
-
-    # Skip weeks with no data
-    # To slice based on a range, pass String, not pd.Timestamp!! https://github.com/pandas-dev/pandas/issues/15252
-    weeks = [w if sum([len(df.loc[str(w[0]):str(w[1])])]) > 0 else None for w in weeks]
-    weeks = [k for k in weeks if k is not None]
-
-    return weeks
+def get_week_range(index):
+    return dh.get_periods(index, 'W')
 
 
 #
-# Generate date range of months inclusive of start and end
+# Generate date range of months with data (times in index), inclusive of start and end
 #
-def get_month_range(df):
-    from pandas.tseries.offsets import MonthEnd, MonthBegin
-
-    return [
-        (m + MonthBegin(), m + MonthEnd() + pd.Timedelta('23:59:59'))
-        for m in list(df.groupby(pd.TimeGrouper(freq='M', closed='left', label='left')).groups)
-    ]
+def get_month_range(index):
+    return dh.get_periods(index, 'M')
 
 
 #
@@ -284,18 +508,52 @@ def read_map(map_filename):
 
 
 #
-# Render template to html and return a string
+# Render template to an html file, streaming it out as it's generated
+#
+def render_template(dest_file, **kwargs):
+    get_environment().get_template('output.htm').stream(**kwargs).dump(dest_file, encoding='utf-8')
+
+
+#
+# Render the report as a list of html documents (sections), in page order: for each series, its cover
+# and then a section per period, followed by the aggregates. Together these have the content of output.htm
 #
-def render_template(**kwargs):
+def render_sections(**kwargs):
+    template = get_environment().get_template('section.htm')
+    sections = []
+
+    for series in kwargs['to_render']:
+        sections.append(template.render(section='cover.htm', section_id='content', series=series, **kwargs))
+        sections += [template.render(section='period.htm', section_id='content', series=series, period=period,
+                                     **kwargs) for period in series]
+
+    sections.append(template.render(section='aggregates.htm', section_id='aggregates', **kwargs))
+    return sections
+
+
+#
+# Jinja environment for the report templates
+#
+def get_environment():
     environment = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=template_dir))
 
     def datetimeformat(value, format='%H:%M / %d-%m-%Y'):
         return value.strftime(format)
 
+    # Figures are passed to the templates as file paths: link to them, or read them in to embed
+    def fileurl(path):
+        return pathlib.Path(path).resolve().as_uri()
+
+    def b64file(path):
+        with open(path, 'rb') as t:
+            return base64.b64encode(t.read()).decode('utf8')
+
     # register it on the template environment by updating the filters dict:
     environment.filters['datetimeformat'] = datetimeformat
+    environment.filters['fileurl'] = fileurl
+    environment.filters['b64file'] = b64file
 
-    return environment.get_template('output.htm').render(**kwargs)
+    return environment
 
 
 #
@@ -306,8 +564,8 @@ def read_arguments():
     parser = argparse.ArgumentParser(description='Generate a report PDF from an input BAX datafile')
 
     # Required args:
-    parser.add_argument("input_datafiles", nargs='+', action="store", type=str,
-                        help="Input file path list (CSV or BIN BAX data)")
+    parser.add_argument("input_datafiles", nargs='*', action="store", type=str,
+                        help="Input file path list (CSV or BIN BAX data). May be empty when reporting from --store")
 
     # Optional args
     parser.add_argument("--outfile",       "-o", dest="output_file",   action="store", type=str, default='out.pdf',
@@ -331,7 +589,41 @@ def read_arguments():
     parser.add_argument("--series",        "-s", nargs='+', type=str,  default=['temp', 'humidity', 'light'],
                         help="Possible values: Temp, Humidity, Light, PIRDiff, RSSI, Battery")
     parser.add_argument("--skip_humidity", "-w", dest="skip_humidity", action="store_true",
-                        help="Skip humidity fixes (which can take a long time)")
+                        help="Skip humidity overflow fixes")
+    parser.add_argument("--cache",         "-c", dest="cache_dir",     action="store", type=str, nargs='?',
+                        const=ca.CACHE_DIR,
+                        help="Cache decoded data files and figures in directory (default {})".format(ca.CACHE_DIR))
+    parser.add_argument("--clear_cache",         dest="clear_cache",   action="store_true",
+                        help="Empty the decoded data and figure caches before reading")
+    parser.add_argument("--chunksize",     "-r", dest="chunksize",     action="store", type=int,
+                        help="Parse CSV input in chunks of this many rows to bound memory use")
+    parser.add_argument("--groupwise",     "-g", dest="groupwise",     action="store_true",
+                        help="Clean all sensors in one frame instead of splitting into a copy per sensor")
+    parser.add_argument("--executor",      "-e", dest="executor",      action="store", type=str,
+                        choices=workers.EXECUTORS, help="How to read data files in parallel (default {})"
+                        .format(workers.DEFAULT_EXECUTOR))
+    parser.add_argument("--workers",       "-j", dest="workers",       action="store", type=int,
+                        help="Maximum number of worker processes/threads (default {})".format(workers.MAX_WORKERS))
+    parser.add_argument("--max_points",          dest="max_points",    action="store", type=int,
+                        help="Downsample each line in a subplot to at most this many points")
+    parser.add_argument("--downsample",          dest="downsample",    action="store", type=str, default='minmax',
+                        choices=gr.DOWNSAMPLE_METHODS, help="Downsampling method for --max_points (default minmax)")
+    parser.add_argument("--format",        "-f", dest="figure_format", action="store", type=str, default='svg',
+                        choices=list(gr.FIGURE_FORMATS),
+                        help="Figure format: vector (svg), raster lines with vector axes (svg-raster) or png")
+    parser.add_argument("--dpi",                 dest="dpi",           action="store", type=int,
+                        help="Resolution of raster figures (png, svg-raster)")
+    parser.add_argument("--pdf_workers",         dest="pdf_workers",   action="store", type=int,
+                        help="Render the PDF in sections on this many processes, then merge them (default: one pass)")
+    parser.add_argument("--store",               dest="store_dir",     action="store", type=str,
+                        help="Ingest new data files into an incremental store in directory, and report from it")
+    parser.add_argument("--start",               dest="start",         action="store", type=str,
+                        help="Report on data from this date/time (with --store), e.g. 2017-01-02")
+    parser.add_argument("--end",                 dest="end",           action="store", type=str,
+                        help="Report on data up to this date/time (with --store), e.g. 2017-01-31")
+    parser.add_argument("--hours",               dest="hours",         nargs='+', type=str, default=['work'],
+                        choices=list(ag.WINDOWS),
+                        help="Hours to make the summary tables for, side by side (default: work, 9am-5pm)")
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-p", "--pdf", action="store_true", default=True, help="Output a PDF file")
@@ -340,7 +632,11 @@ def read_arguments():
     parser.add_argument('--verbose', '-v', dest="verbose", action="count")
 
     # Parse 'em 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.input_datafiles and args.store_dir is None:
+        parser.error("input_datafiles are required unless reporting from --store")
+
+    return args
 
 
 #
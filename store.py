@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Incremental store of cleaned BAX data
+#
+# New data files are ingested into a directory of cleaned, per-sensor data so that weekly uploads
+# don't require the full history to be reprocessed for every report:
+#
+#     <store_dir>/meta.json                          Options, ingested files, sensor order and humidity state
+#     <store_dir>/<sensor>/<YYYY-MM>.parquet         Cleaned rows for one sensor and month
+#     <store_dir>/<sensor>/<YYYY-MM>.hourly.parquet  Hourly rollup of the month's rows (see dh.rollup)
+#     <store_dir>/<sensor>/tail.parquet              Last TAIL_ROWS rows for the sensor, before fix_humidity
+#
+# Only the new rows are cleaned, along with enough of the stored tail to cover the windows used by
+# datahandling.clean_data (5 samples for fix_humidity, 250 for the rolling std. deviation in diff_pir)
+# and each sensor's humidity overflow state, kept in meta.json, so the stored data is the same as
+# cleaning the whole history at once. This assumes that new files
+# carry later data: rows at or before a sensor's last stored time are dropped (rebuild the store to
+# insert older data).
+#
+# Each month's rollup is rewritten with its rows, so summaries of a long period (e.g. the aggregate tables)
+# can be read from load_rollups (or a month at a time, from iter_months) without touching the samples.
+# Rollups missing from a store built before they were added are made from the month's rows the first
+# time they're loaded.
+#
+import os
+import json
+import time
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import cache
+import datahandling as dh
+
+log = logging.getLogger(__name__)
+
+STORE_VERSION = 's2'
+META_FILE = 'meta.json'
+TAIL_FILE = 'tail.parquet'
+ROLLUP_SUFFIX = '.hourly.parquet'
+
+# Rows of overlap needed to clean new data: diff_pir's rolling window (250) over the second
+# difference of PIREnergy (2) plus the rows replaced because their humidity window was incomplete (2)
+TAIL_ROWS = 254
+HUMIDITY_WINDOW = 5
+
+
+#
+# Ingest new BAX datafiles into the store, creating it if needed.
+# Files which have already been ingested (by content hash) are skipped
+#
+def ingest(store_dir, input_datafiles: list, exclude_subnet=None, exclude_sensors=None, skip_humidity=False,
+           cache_dir=None, chunksize=None, executor=None):
+    options = {
+        'exclude_subnet': exclude_subnet,
+        'exclude_sensors': sorted(exclude_sensors) if exclude_sensors else None,
+        'skip_humidity': bool(skip_humidity),
+    }
+
+    meta = read_meta(store_dir)
+    if meta is None:
+        meta = {'version': version(), 'options': options, 'files': [], 'sensors': [], 'state': {},
+                't_start': None, 't_end': None}
+    elif meta['version'] != version():
+        raise ValueError("Store {0} is version {1}, expected {2}: rebuild it"
+                         .format(store_dir, meta['version'], version()))
+    elif meta['options'] != options:
+        raise ValueError("Store {0} was built with options {1}: rebuild it to use {2}"
+                         .format(store_dir, meta['options'], options))
+
+    # Skip files that are already in the store
+    hashes = {f: cache.file_hash(f) for f in input_datafiles}
+    new_files = [f for f in input_datafiles if hashes[f] not in meta['files']]
+    if not new_files:
+        log.info("No new data files to ingest into {0}".format(store_dir))
+        return meta
+
+    start_time = time.time()
+    df = dh.read_files(new_files, cache_dir=cache_dir, chunksize=chunksize, executor=executor)
+
+    t_start, t_end = (df.index.min(), df.index.max())
+    meta['t_start'] = str(min(t_start, pd.Timestamp(meta['t_start']))) if meta['t_start'] else str(t_start)
+    meta['t_end'] = str(max(t_end, pd.Timestamp(meta['t_end']))) if meta['t_end'] else str(t_end)
+
+    dh.fix_names(df)
+
+    if exclude_sensors is not None:
+        dh.drop_sensors(df, exclude_sensors)
+
+    if exclude_subnet is not None:
+        dh.drop_subnet(df, exclude_subnet)
+
+    # Per-sensor fixes which don't depend on neighbouring rows
+    dfs = dh.fix_light(dh.limit_range(dh.split_by_id(df)))
+
+    # New sensors are appended to the (first appearance) order used to clean the data
+    meta['sensors'] += [i for i in dfs if i not in meta['sensors']]
+
+    # Each sensor resumes from its own humidity overflow state (see dh.fix_humidity)
+    for i in meta['sensors']:
+        if i in dfs:
+            ingest_sensor(store_dir, i, dfs[i], meta['state'], skip_humidity)
+
+    meta['files'] += [hashes[f] for f in new_files]
+    write_meta(store_dir, meta)
+
+    log.info("+ Ingested {0} files into {1} in {2:.2f}s".format(len(new_files), store_dir, time.time() - start_time))
+    return meta
+
+
+#
+# Clean new rows for one sensor against its stored tail and append them to the store,
+# updating the sensor's humidity overflow state in `state`
+#
+def ingest_sensor(store_dir, sensor, new, state, skip_humidity=False):
+    sensor_dir = os.path.join(store_dir, sensor)
+    tail_path = os.path.join(sensor_dir, TAIL_FILE)
+
+    # Sensors are cleaned one at a time, so the Name column isn't stored
+    new = new.drop(columns='Name')
+    tail = pd.read_parquet(tail_path) if os.path.isfile(tail_path) else new.iloc[:0]
+
+    # Rows must follow the stored data
+    if len(tail) and (new.index <= tail.index[-1]).any():
+        log.warning("Dropping {0} rows for {1} at or before {2}, already in the store"
+                    .format((new.index <= tail.index[-1]).sum(), sensor, tail.index[-1]))
+        new = new[new.index > tail.index[-1]]
+
+    if new.empty:
+        return
+
+    frame = pd.concat([tail, new.astype(tail.dtypes.to_dict()) if len(tail) else new])
+    new_tail = frame.iloc[-TAIL_ROWS:].copy()
+
+    # The last rows stored had incomplete humidity windows: clean them again along with the new rows
+    replace = min(len(tail), HUMIDITY_WINDOW // 2)
+
+    if not skip_humidity:
+        # Resume from the stored state with enough earlier rows to fill the window
+        start = max(len(tail) - replace - HUMIDITY_WINDOW // 2, 0)
+
+        humidity = dh.fix_humidity({sensor: frame.iloc[start:].copy()}, state)[sensor]['Humidity']
+        frame['Humidity'] = frame['Humidity'].values
+        frame.iloc[start:, frame.columns.get_loc('Humidity')] = humidity.values
+
+    frame = dh.diff_pir(dh.fix_temp({sensor: frame}))[sensor]
+
+    write_partitions(sensor_dir, frame.iloc[len(tail) - replace:], replace)
+    new_tail.to_parquet(tail_path)
+
+
+#
+# Append cleaned rows to a sensor's monthly partitions, first removing the last `replace` rows stored
+#
+def write_partitions(sensor_dir, rows, replace=0):
+    os.makedirs(sensor_dir, exist_ok=True)
+    months = [m + '.parquet' for m in list_months(sensor_dir)]
+    partitions = {}
+
+    # Replaced rows are the newest: remove them from the end of the latest partitions
+    for month in reversed(months):
+        if replace <= 0:
+            break
+        part = pd.read_parquet(os.path.join(sensor_dir, month))
+        n = min(replace, len(part))
+        partitions[month] = part.iloc[:len(part) - n]
+        replace -= n
+
+    # Rows are in time order: split them at month boundaries (datetime64[M] formats as 'YYYY-MM')
+    months = rows.index.values.astype('datetime64[M]')
+    bounds = np.flatnonzero(months[1:] != months[:-1]) + 1
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(rows)]):
+        month, group = str(months[start]) + '.parquet', rows.iloc[start:end]
+        if month not in partitions:
+            path = os.path.join(sensor_dir, month)
+            partitions[month] = pd.read_parquet(path) if os.path.isfile(path) else group.iloc[:0]
+        partitions[month] = pd.concat([partitions[month], group])
+
+    for month, part in partitions.items():
+        path = os.path.join(sensor_dir, month)
+        rollup_path = path[:-len('.parquet')] + ROLLUP_SUFFIX
+        if part.empty:
+            os.remove(path)
+            if os.path.isfile(rollup_path):
+                os.remove(rollup_path)
+        else:
+            write_parquet(part, path)
+            write_parquet(dh.rollup_frame(part), rollup_path)
+
+
+#
+# Write a frame to a parquet file (atomically, via a temporary file)
+#
+def write_parquet(df, path):
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+#
+# Return the months ('YYYY-MM') stored for a sensor, in order
+#
+def list_months(sensor_dir):
+    return sorted(m[:-len('.parquet')] for m in os.listdir(sensor_dir)
+                  if m.endswith('.parquet') and m != TAIL_FILE and not m.endswith(ROLLUP_SUFFIX))
+
+
+#
+# Load cleaned data from the store, optionally limited to the period t_start to t_end (inclusive),
+# reading only the monthly partitions needed. Returns (df, dfs, t_start, t_end) as dh.read_data does,
+# with df None if there's no data in the period.
+# Pass a list of sensors to load only theirs: dfs then has a frame for each of them, in that order,
+# which is empty for a sensor without data in the period
+#
+def load(store_dir, t_start=None, t_end=None, sensors=None):
+    meta = open_store(store_dir)
+
+    t_start = pd.Timestamp(t_start) if t_start is not None else None
+    t_end = pd.Timestamp(t_end) if t_end is not None else None
+    first_month = t_start.strftime('%Y-%m') if t_start is not None else ''
+    last_month = t_end.strftime('%Y-%m') if t_end is not None else '9999-99'
+
+    names = pd.CategoricalDtype(meta['sensors'])
+    dfs = {}
+    for i in (sensors if sensors is not None else meta['sensors']):
+        sensor_dir = os.path.join(store_dir, i)
+        months = [m for m in list_months(sensor_dir) if first_month <= m <= last_month]
+
+        if months:
+            df = pd.concat([pd.read_parquet(os.path.join(sensor_dir, m + '.parquet')) for m in months])
+            df = df.loc[t_start:t_end]
+        elif sensors is not None:
+            df = empty_partition(sensor_dir)
+        else:
+            continue
+
+        if df.empty and sensors is None:
+            continue
+
+        df.insert(0, 'Name', pd.Categorical([i] * len(df), dtype=names))
+        dfs[i] = df
+
+    log.info("Loaded {0} sensors from {1}".format(len(dfs), store_dir))
+
+    return (pd.concat(dfs.values()) if any(len(df) for df in dfs.values()) else None, dfs,
+            *data_range(meta, t_start, t_end))
+
+
+#
+# The period of the stored data (from the store's metadata), limited to t_start to t_end if given
+#
+def data_range(meta, t_start=None, t_end=None):
+    data_start, data_end = pd.Timestamp(meta['t_start']), pd.Timestamp(meta['t_end'])
+    return (max(data_start, pd.Timestamp(t_start)) if t_start is not None else data_start,
+            min(data_end, pd.Timestamp(t_end)) if t_end is not None else data_end)
+
+
+#
+# An empty frame with the columns of a sensor's partitions (read from a partition's schema, not its rows)
+#
+def empty_partition(sensor_dir):
+    path = os.path.join(sensor_dir, list_months(sensor_dir)[0] + '.parquet')
+    return pq.read_schema(path).empty_table().to_pandas()
+
+
+#
+# Count each sensor's rows from t_start to t_end (inclusive), reading only the time index of the monthly
+# partitions needed, a partition at a time. Sensors without rows in the period are left out
+#
+def count_rows(store_dir, t_start=None, t_end=None):
+    meta = open_store(store_dir)
+
+    t_start = pd.Timestamp(t_start) if t_start is not None else None
+    t_end = pd.Timestamp(t_end) if t_end is not None else None
+    first_month = t_start.strftime('%Y-%m') if t_start is not None else ''
+    last_month = t_end.strftime('%Y-%m') if t_end is not None else '9999-99'
+
+    counts = {}
+    for i in meta['sensors']:
+        sensor_dir = os.path.join(store_dir, i)
+        rows = 0
+        for m in list_months(sensor_dir):
+            if first_month <= m <= last_month:
+                index = pd.read_parquet(os.path.join(sensor_dir, m + '.parquet'), columns=[]).index
+                rows += len(index[index.slice_indexer(t_start, t_end)])
+        if rows:
+            counts[i] = rows
+
+    return counts
+
+
+#
+# Load the hourly rollups (as dh.rollup returns) of the stored data, optionally limited to the hours from
+# t_start to t_end (to the hour: those which they fall in are included), reading only the rollups' files
+#
+def load_rollups(store_dir, t_start=None, t_end=None):
+    meta = open_store(store_dir)
+
+    t_start = pd.Timestamp(t_start).floor('h') if t_start is not None else None
+    t_end = pd.Timestamp(t_end) if t_end is not None else None
+    first_month = t_start.strftime('%Y-%m') if t_start is not None else ''
+    last_month = t_end.strftime('%Y-%m') if t_end is not None else '9999-99'
+
+    names = pd.CategoricalDtype(meta['sensors'])
+    rollups = {}
+    for i in meta['sensors']:
+        sensor_dir = os.path.join(store_dir, i)
+        months = [m for m in list_months(sensor_dir) if first_month <= m <= last_month]
+        if not months:
+            continue
+
+        df = pd.concat([read_rollup(sensor_dir, m) for m in months])
+        df = df.loc[t_start:t_end]
+        if df.empty:
+            continue
+
+        df.insert(0, 'Name', pd.Categorical([i] * len(df), dtype=names))
+        rollups[i] = df
+
+    return rollups
+
+
+#
+# Load daily rollups (as dh.resample_rollup makes from the hourly rollups) of the stored data, optionally limited
+# to the period t_start to t_end (to the hour, as load_rollups), resampling the hourly rollups a month at a time
+#
+def load_daily(store_dir, t_start=None, t_end=None):
+    daily = {}
+    for month in iter_months(store_dir, t_start, t_end, rollups=True):
+        for i, df in dh.resample_rollup(dh.split_by_id(month), 'D').items():
+            daily.setdefault(i, []).append(df)
+
+    return {i: pd.concat(frames) for i, frames in daily.items()}
+
+
+#
+# Iterate over the stored data one month at a time, optionally limited to the period t_start to t_end: yields a
+# frame of every sensor's rows for the month (as load's df), or with rollups=True their hourly rollups (limited
+# to the hour, as load_rollups). Only the month is read, so the data as a whole needn't fit in memory
+# (e.g. for aggregate.aggregate_partitions)
+#
+def iter_months(store_dir, t_start=None, t_end=None, rollups=False):
+    meta = open_store(store_dir)
+
+    t_start = pd.Timestamp(t_start) if t_start is not None else None
+    t_end = pd.Timestamp(t_end) if t_end is not None else None
+    if rollups and t_start is not None:
+        t_start = t_start.floor('h')
+    first_month = t_start.strftime('%Y-%m') if t_start is not None else ''
+    last_month = t_end.strftime('%Y-%m') if t_end is not None else '9999-99'
+
+    names = pd.CategoricalDtype(meta['sensors'])
+    sensor_months = {i: set(list_months(os.path.join(store_dir, i))) for i in meta['sensors']}
+
+    for month in sorted(m for m in set().union(*sensor_months.values()) if first_month <= m <= last_month):
+        frames = []
+        for i in meta['sensors']:
+            if month not in sensor_months[i]:
+                continue
+
+            sensor_dir = os.path.join(store_dir, i)
+            if rollups:
+                df = read_rollup(sensor_dir, month)
+            else:
+                df = pd.read_parquet(os.path.join(sensor_dir, month + '.parquet'))
+            df = df.loc[t_start:t_end]
+            if df.empty:
+                continue
+
+            df.insert(0, 'Name', pd.Categorical([i] * len(df), dtype=names))
+            frames.append(df)
+
+        if frames:
+            yield pd.concat(frames)
+
+
+#
+# Read the hourly rollup of one of a sensor's months, making it from the month's rows if it's missing
+#
+def read_rollup(sensor_dir, month):
+    path = os.path.join(sensor_dir, month + ROLLUP_SUFFIX)
+    if os.path.isfile(path):
+        return pd.read_parquet(path)
+
+    df = dh.rollup_frame(pd.read_parquet(os.path.join(sensor_dir, month + '.parquet')))
+    write_parquet(df, path)
+    return df
+
+
+#
+# Read the metadata of a store to load from, checking that it's usable
+#
+def open_store(store_dir):
+    meta = read_meta(store_dir)
+    if meta is None:
+        raise FileNotFoundError("No data store in {0}".format(store_dir))
+    if meta['version'] != version():
+        raise ValueError("Store {0} is version {1}, expected {2}: rebuild it"
+                         .format(store_dir, meta['version'], version()))
+    return meta
+
+
+#
+# Read the store's metadata, or None if there's no store yet
+#
+def read_meta(store_dir):
+    path = os.path.join(store_dir, META_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+#
+# Write the store's metadata (atomically, once the data has been written)
+#
+def write_meta(store_dir, meta):
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, META_FILE)
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+#
+# Version of the stored data: changes with the parser or the store layout
+#
+def version():
+    return "{0}-{1}".format(dh.PARSER_VERSION, STORE_VERSION)
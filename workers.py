@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Executors for running work (e.g. decoding data files) in parallel
+#
+#     'process'  Shared pool of worker processes, reused across calls (and concurrent report jobs)
+#     'thread'   Shared pool of threads: suits work which waits on a subprocess, like BAXTest in df_from_bin
+#     'serial'   Run in the calling thread
+#
+# Each shared pool is capped at MAX_WORKERS, so several report jobs running at once (e.g. in the
+# threaded server) queue for the same workers instead of each starting a pool of their own.
+#
+# DataFrames returned by process workers aren't pickled back through a pipe: they're written to
+# uncompressed Arrow (Feather) files in shared memory (/dev/shm, where available) and read back by
+# the caller, which removes them. Going the other way, share_frames publishes sensor data once to a
+# memory-mapped file which any number of workers can read (attach_frames) without copying.
+#
+import os
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+EXECUTORS = ('process', 'thread', 'serial')
+DEFAULT_EXECUTOR = os.environ.get('BAX_EXECUTOR', 'process')
+MAX_WORKERS = int(os.environ.get('BAX_MAX_WORKERS', os.cpu_count() or 1))
+
+# Directory for data handed to and back from worker processes (shared memory, if there is some)
+HANDOFF_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+_pools = {}     # executor type: current shared pool
+_users = {}     # pool: number of callers using it
+_pools_lock = threading.Lock()
+
+
+#
+# Use the shared pool for an executor type (creating it on first use) in a with block:
+#
+#     with use_pool('process') as pool:
+#         pool.submit(...)
+#
+# A pool replaced while callers are using it (by set_max_workers, or after it broke) is shut down once the
+# last of them is done with it, so no caller finds its pool shut down while it's still submitting work
+#
+@contextlib.contextmanager
+def use_pool(executor):
+    with _pools_lock:
+        if executor not in _pools:
+            log.debug("Starting {0} pool with {1} workers".format(executor, MAX_WORKERS))
+            if executor == 'process':
+                _pools[executor] = concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS,
+                                                                          mp_context=get_context())
+            else:
+                _pools[executor] = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        pool = _pools[executor]
+        _users[pool] = _users.get(pool, 0) + 1
+
+    try:
+        yield pool
+
+    finally:
+        with _pools_lock:
+            _users[pool] -= 1
+            if not _users[pool]:
+                del _users[pool]
+                if _pools.get(executor) is not pool:
+                    pool.shutdown(wait=False)
+
+
+#
+# Replace the shared pool for an executor type (e.g. after a worker died): the next caller starts afresh
+#
+def discard_pool(executor, pool):
+    with _pools_lock:
+        if _pools.get(executor) is pool:
+            del _pools[executor]
+            if pool not in _users:
+                pool.shutdown(wait=False)
+
+
+#
+# Change the number of workers. Pools in use are shut down once their callers are done with them,
+# and new pools are started with the new size on next use
+#
+def set_max_workers(max_workers):
+    global MAX_WORKERS
+    with _pools_lock:
+        if max_workers != MAX_WORKERS:
+            MAX_WORKERS = max_workers
+            for pool in _pools.values():
+                if pool not in _users:
+                    pool.shutdown(wait=False)
+            _pools.clear()
+
+
+#
+# Shut down the shared pools (e.g. before exiting)
+#
+def shutdown():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+        _pools.clear()
+
+
+#
+# Context for starting worker processes which don't inherit this process' state (e.g. a GUI backend):
+# a forkserver where there is one, otherwise spawn
+#
+def get_context():
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+
+#
+# Apply func to each item using the given executor, returning a list of results in order
+#
+def map(func, items, executor=None):
+    executor = executor or DEFAULT_EXECUTOR
+    if executor not in EXECUTORS:
+        raise ValueError("Unknown executor '{0}': use one of {1}".format(executor, ", ".join(EXECUTORS)))
+
+    items = list(items)
+    if executor == 'serial' or len(items) <= 1:
+        return [func(item) for item in items]
+
+    if executor == 'thread':
+        with use_pool(executor) as pool:
+            return list(pool.map(func, items))
+
+    handoff_dir = tempfile.mkdtemp(prefix='reportgen-', dir=HANDOFF_DIR)
+    try:
+        with use_pool(executor) as pool:
+            try:
+                futures = [pool.submit(call_to_file, func, item, handoff_dir) for item in items]
+                return [read_result(f.result()) for f in futures]
+
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker died (e.g. killed for using too much memory): discard the pool so the next call
+                # starts afresh
+                discard_pool(executor, pool)
+                raise
+
+    finally:
+        shutil.rmtree(handoff_dir, ignore_errors=True)
+
+
+#
+# Run tasks (picklable callables, e.g. functools.partial of a module-level function) on the shared process pool,
+# with at most max_tasks of them running at once (default: as many as there are workers), returning their
+# results in order. Work run this way counts against MAX_WORKERS along with everything else on the pool
+#
+def run(tasks, max_tasks=None):
+    tasks = list(tasks)
+    results = [None] * len(tasks)
+
+    with use_pool('process') as pool:
+        try:
+            running = {}
+            for i, task in enumerate(tasks):
+                if max_tasks and len(running) >= max_tasks:
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in done:
+                        results[running.pop(f)] = f.result()
+                running[pool.submit(task)] = i
+
+            for f, i in running.items():
+                results[i] = f.result()
+
+        except concurrent.futures.process.BrokenProcessPool:
+            discard_pool('process', pool)
+            raise
+
+    return results
+
+
+#
+# Run func(item) in a worker process, writing a DataFrame result to a file in handoff_dir.
+# Returns ('file', path) for a written result, or ('value', result) for anything else
+#
+def call_to_file(func, item, handoff_dir):
+    result = func(item)
+
+    if isinstance(result, pd.DataFrame):
+        path = os.path.join(handoff_dir, "{0}.arrow".format(uuid.uuid4().hex))
+        result.reset_index().to_feather(path, compression='uncompressed')
+        return 'file', (path, list(result.index.names))
+
+    return 'value', result
+
+
+#
+# Read back a result returned by call_to_file
+#
+def read_result(result):
+    kind, value = result
+    if kind != 'file':
+        return value
+
+    path, index_names = value
+    df = pd.read_feather(path)
+    os.remove(path)
+
+    # Restore the index (the leading columns, from reset_index)
+    df = df.set_index(list(df.columns[:len(index_names)]))
+    df.index.names = index_names
+    return df
+
+
+#
+# Publish columns of each sensor's frame, with its time index, to one memory-mapped file in handoff_dir.
+# Returns the layout (small, and cheap to pass to workers) that attach_frames needs to read them back
+#
+def share_frames(dfs, columns, handoff_dir):
+    path = os.path.join(handoff_dir, "{0}.frames".format(uuid.uuid4().hex))
+    layout = {'path': path, 'sensors': []}
+    arrays = []
+    offset = 0
+
+    for name in dfs:
+        df = dfs[name]
+        entry = []
+        for column, values in [(None, df.index.values)] + [(c, df[c].values) for c in columns if c in df]:
+            values = np.ascontiguousarray(values)
+            offset += -offset % 8  # Keep arrays aligned
+            entry.append((column, values.dtype.str, offset, len(values)))
+            arrays.append((offset, values))
+            offset += values.nbytes
+
+        layout['sensors'].append((name, df.index.name, entry))
+
+    mm = np.memmap(path, dtype=np.uint8, mode='w+', shape=(max(offset, 1),))
+    for offset, values in arrays:
+        mm[offset:offset + values.nbytes] = values.view(np.uint8)
+    mm.flush()
+    del mm
+
+    return layout
+
+
+#
+# Map the data published by share_frames back into a dict of DataFrames, optionally only the rows
+# from t_start to t_end (inclusive). Arrays are read straight from the mapped (shared) pages
+#
+def attach_frames(layout, t_start=None, t_end=None):
+    mm = np.memmap(layout['path'], dtype=np.uint8, mode='r')
+    dfs = {}
+
+    for name, index_name, entry in layout['sensors']:
+        arrays = {column: np.frombuffer(mm, dtype=dtype, count=n, offset=offset)
+                  for column, dtype, offset, n in entry}
+        index = arrays.pop(None)
+
+        start = np.searchsorted(index, np.datetime64(t_start), 'left') if t_start is not None else 0
+        end = np.searchsorted(index, np.datetime64(t_end), 'right') if t_end is not None else len(index)
+
+        dfs[name] = pd.DataFrame({column: values[start:end] for column, values in arrays.items()},
+                                 index=pd.DatetimeIndex(index[start:end], name=index_name), copy=False)
+
+    return dfs